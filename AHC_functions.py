@@ -825,21 +825,22 @@ def segmented_props_list_builder(CS_data, seg_phasemaps_list, post_processed_dat
         if verbose_flag:
             print("calculating segmented "+prop_plane+" propagation data...")
             
-        for CS_ID, CS in enumerate(CS_data):
+        seg_props_list = [[None]*len(seg_phasemaps_list[CS_ID]) for CS_ID in range(len(CS_data))]
+        
+        # each pattern has its own propagator, so propagate every CS level of a pattern in one batched product
+        for i in range(len(seg_phasemaps_list[0])):
             
-            seg_props = []
+            seg_phasemaps = np.array([seg_phasemaps_list[CS_ID][i] for CS_ID in range(len(CS_data))])
+            surface_pressures = abs(Pf)*np.exp(1j*(seg_phasemaps + np.angle(Pf)))
+            prop_vecs = GF_prop(surface_pressures.reshape(len(CS_data), -1), H_list[i], "forward")
               
-            for i, seg_phasemap in enumerate(seg_phasemaps_list[CS_ID]):
+            for CS_ID, prop_vec in enumerate(prop_vecs):
 
-                surface_pressure = abs(Pf)*np.exp(1j*(seg_phasemap + np.angle(Pf)))
-                prop_vec = GF_prop(surface_pressure.flatten(), H_list[i], "forward")
                 prop_mat = prop_vec.reshape(output_shape)
                 if flip_flag:
-                    seg_props.append(np.flipud(prop_mat))
+                    seg_props_list[CS_ID][i] = np.flipud(prop_mat)
                 else:
-                    seg_props.append(prop_mat)
-                
-            seg_props_list.append(seg_props)
+                    seg_props_list[CS_ID][i] = prop_mat
 
         if data_save_flag:
             np.save(post_processed_data_folder+"/seg_props_list_"+prop_plane+".npy", seg_props_list)
@@ -1,76 +1,237 @@
 import os
 import time
+import functools
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import itertools as it
 import math as math
 from scipy.special import comb
+from functions import real_dtype, complex_dtype, get_precision
+from fft_functions import fft2, ifft2, ifft
 
     
-def ASM_fw(f, cell_spacing, target_dist, k):
+@functools.lru_cache(maxsize=16)
+def ASM_kz(shape, cell_spacing, k, precision):
+    
+    """
+    
+    finds the axial wavenumber, kz = sqrt(k**2 - kx**2 - ky**2), of every spatial frequency of a field, in unshifted
+    FFT order (kz is imaginary for evanescent waves). Results are kept in a small LRU cache.
+    
+    args:
+        shape: (N0, N1) shape of the padded field.
+        cell_spacing: seperation between samples of the field [m].
+        k: wavenumber.
+        precision: "single" or "double".
+        
+    returns:
+        kz: read-only complex axial wavenumbers (N0, N1).
+    
+    """
+    
+    real = real_dtype(precision)
+    Nfft = shape
+    kx = (2*np.pi*(np.arange(-Nfft[0]/2, (Nfft[0])/2)/((cell_spacing)*Nfft[0]))) \
+    .reshape((1, Nfft[0])).astype(real) # kx vector
+    ky = (2*np.pi*(np.arange(-Nfft[1]/2, (Nfft[1])/2)/((cell_spacing)*Nfft[1]))) \
+    .reshape((1, Nfft[1])).astype(real) # ky vector
+    k = real.type(k)
+    
+    # move from centred order to FFT order once, instead of shifting every spectrum
+    kz = np.fft.ifftshift(np.lib.scimath.sqrt(k**2 - kx**2 - (ky**2).T).T)
+    kz.flags.writeable = False
+    
+    return kz
+
+
+@functools.lru_cache(maxsize=16)
+def ASM_plan_builder(shape, cell_spacing, target_dist, k, direction, precision, band_limit=False):
+    
+    """
+    
+    builds the ASM propagator for a geometry, in unshifted FFT order so that it multiplies the output of fft2
+    directly. Results are kept in a small LRU cache (ASM_plan_builder.cache_clear() empties it), so use "ASM_plan"
+    which normalises its arguments before looking them up.
+    
+    args:
+        shape: (N0, N1) shape of the padded field.
+        cell_spacing: seperation between samples of the field [m].
+        target_dist: distance to propagation plane [m].
+        k: wavenumber.
+        direction: "forward" or "backward" (the conjugate propagator).
+        precision: "single" or "double".
+        band_limit: (False) if True, spatial frequencies the padded field samples too coarsely are removed.
+        
+    returns:
+        H: read-only complex propagator (N0, N1).
+    
+    """
+    
+    kz = ASM_kz(shape, cell_spacing, k, precision)
+    
+    H = np.exp(1j*kz*real_dtype(precision).type(target_dist)) # propagator function
+    
+    if band_limit:
+        
+        # band-limited ASM (Matsushima & Shimobaba, 2009): along an axis of N samples the phase of H is only sampled
+        # finely enough for |kx| < k/sqrt((2*z/(N*cell_spacing))**2 + 1), beyond which it aliases into wrap-around
+        for axis, N in enumerate(shape):
+            kx = np.fft.ifftshift(2*np.pi*np.arange(-N/2, N/2)/(cell_spacing*N))
+            kx_limit = k/np.sqrt((2*target_dist/(N*cell_spacing))**2 + 1)
+            H = H*np.expand_dims(abs(kx) < kx_limit, 1 - axis)
+    
+    # conjugate of propagator will result in backpropagation
+    if direction == "backward":
+        H = np.conj(H)
+    
+    H = H.astype(complex_dtype(precision), copy=False)
+    H.flags.writeable = False
+    
+    return H
+
+
+def ASM_plan(shape, cell_spacing, target_dist, k, direction="forward", precision=None, band_limit=False):
+    
+    """
+    
+    returns the (cached) ASM propagator for a geometry, in unshifted FFT order. Repeated calls with the same
+    geometry, e.g. every iteration of "ASM_Iterative_GS", reuse the same array.
+    
+    args:
+        shape: (N0, N1) shape of the padded field.
+        cell_spacing: seperation between samples of the field [m].
+        target_dist: distance to propagation plane [m].
+        k: wavenumber.
+        direction: ("forward") "forward" or "backward".
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        band_limit: (False) if True, the band-limited propagator is returned (see "ASM_plan_builder").
+        
+    returns:
+        H: read-only complex propagator (N0, N1).
+    
+    """
+    
+    if direction not in ("forward", "backward"):
+        raise ValueError(str(direction) + " is not a valid direction, please specify either 'forward' or 'backward'.")
+    
+    return ASM_plan_builder(tuple(int(N) for N in shape), float(cell_spacing), float(target_dist), float(k),
+                            direction, get_precision(precision), bool(band_limit))
+
+    
+def ASM_fw(f, cell_spacing, target_dist, k, precision=None, out=None, band_limit=False):
     
     """
     
     Forward ASM
     
     args:
-        f: complex surface pressure
+        f: complex surface pressure, or a stack of them along a leading axis (propagated with one batched FFT)
         cell_spacing: seperation between cells on the metasurface
         target_dist: distance to propagation plane
         k: wavenumber
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        out: optional preallocated array for the result, with the shape of f. Both FFTs run in it, so no other
+        array is allocated.
+        band_limit: (False) if True, the band-limited propagator is used (see "ASM_plan_builder").
         
     returns:
     
     """
     
-    Nfft = f.shape
-    kx = (2*np.pi*(np.arange(-Nfft[0]/2, (Nfft[0])/2)/((cell_spacing)*Nfft[0]))) \
-    .reshape((1, Nfft[0])) # kx vector
-    ky = (2*np.pi*(np.arange(-Nfft[1]/2, (Nfft[1])/2)/((cell_spacing)*Nfft[1]))) \
-    .reshape((1, Nfft[1])) # ky vector
-    F = np.fft.fft2(f) # 2D FT
-    F = np.fft.fftshift(F) # Shift to the centre
-    
-    ## Propagate forwards    
-    H = np.exp(1j*np.lib.scimath.sqrt(k**2 - kx**2 - (ky**2).T)*target_dist) # propagator function
-    Gf = F*H.T # propagating the signal forward in Fourier space
-    gf = np.fft.ifft2(np.fft.ifftshift(Gf)) # IFT & shift to return to real space
+    f = np.asarray(f, dtype=complex_dtype(precision))
+    H = ASM_plan(f.shape[-2:], cell_spacing, target_dist, k, "forward", precision, band_limit) # propagator function
+    Gf = fft2(f, out=out) # 2D FT (into out, if given)
+    Gf *= H # propagating the signal forward in Fourier space
+    gf = ifft2(Gf, out=Gf, overwrite_input=True).astype(f.dtype, copy=False) # IFT to return to real space, in place
     return gf
 
-def ASM_bw(f, cell_spacing, target_plane, k):
+def ASM_bw(f, cell_spacing, target_plane, k, precision=None, out=None, band_limit=False):
     
     """
     
     Backward ASM
     
     args:
-        f: complex surface pressure
+        f: complex surface pressure, or a stack of them along a leading axis (propagated with one batched FFT)
         cell_spacing: seperation between cells on the metasurface
         target_dist: distance to propagation plane
         k: wavenumber
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        out: optional preallocated array for the result, with the shape of f. Both FFTs run in it, so no other
+        array is allocated.
+        band_limit: (False) if True, the band-limited propagator is used (see "ASM_plan_builder").
     
     returns:
         
         
     """
     
-    Nfft = f.shape
-    kx = (2*np.pi*(np.arange(-Nfft[0]/2, (Nfft[0])/2)/((cell_spacing)*Nfft[0]))) \
-    .reshape((1, Nfft[0])) # kx vector
-    ky = (2*np.pi*(np.arange(-Nfft[1]/2, (Nfft[1])/2)/((cell_spacing)*Nfft[1]))) \
-    .reshape((1, Nfft[1])) # ky vector
-    F = np.fft.fft2(f) # 2D FT
-    F = np.fft.fftshift(F) # Shift to the centre
-    
-    ## Propagate backwards
-    H = np.exp(1j * np.lib.scimath.sqrt(k ** 2 - kx ** 2 - (ky ** 2).T) * target_plane)  # propagator function
-    Hb = np.conj(H)  # conjugate of propagator will result in backpropagation
-    Gb = F * Hb.T  # propagating backwards from target to lens
-    gb = np.fft.ifft2(np.fft.ifftshift(Gb))  # IFT & shift to return to real space
+    f = np.asarray(f, dtype=complex_dtype(precision))
+    Hb = ASM_plan(f.shape[-2:], cell_spacing, target_plane, k, "backward", precision, band_limit) # conjugate propagator
+    Gb = fft2(f, out=out)  # 2D FT (into out, if given)
+    Gb *= Hb  # propagating backwards from target to lens
+    gb = ifft2(Gb, out=Gb, overwrite_input=True).astype(f.dtype, copy=False)  # IFT to return to real space, in place
     return gb  # return backpropagation
     
-def ASM_prop(surface_pressure, cell_spacing, target_dist, resolution, k):
+def ASM_upsampled_spectrum(surface_pressure, resolution, upsampling="kron", precision=None):
+    
+    """
+    
+    finds the spectrum (in unshifted FFT order) of the surface pressure upsampled by resolution in each axis.
+    
+    args:
+        surface_pressure: complex surface pressure (N0, N1).
+        resolution: number of sample points for each point in the input phasemap.
+        upsampling: how the cells are upsampled:
+            "kron": piecewise-constant cells, by FFT of np.kron(surface_pressure, np.ones((resolution, resolution))).
+            "spectral": the same piecewise-constant cells, found from the FFT at native resolution. The spectrum of
+            the upsampled field is the periodic native spectrum times the spectrum of one cell, so the upsampled
+            field is never built and the forward FFT is resolution**2 times smaller.
+            "bandlimited": band-limited (sinc) interpolation of the cell values, found by zero-padding the native
+            spectrum. Cell values sit at the cell centres, as for "kron".
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        
+    returns:
+        spectrum: complex spectrum (N0*resolution, N1*resolution).
+    
+    """
+    
+    if upsampling not in ("kron", "spectral", "bandlimited"):
+        raise ValueError(str(upsampling) + " is not a valid upsampling, please specify 'kron', 'spectral' or 'bandlimited'.")
+    
+    surface_pressure = np.asarray(surface_pressure, dtype=complex_dtype(precision))
+    
+    if upsampling == "kron":
+        f = np.kron(surface_pressure, np.ones((resolution, resolution), dtype=real_dtype(precision)))
+        return fft2(f).astype(f.dtype, copy=False)
+    
+    P = fft2(surface_pressure).astype(surface_pressure.dtype, copy=False) # 2D FT at native resolution
+    fine_shape = (surface_pressure.shape[0]*resolution, surface_pressure.shape[1]*resolution)
+    
+    if upsampling == "spectral":
+        
+        # spectrum of a single cell of resolution samples along each axis (a geometric series)
+        cell_spectra = [np.sum(np.exp(-2j*np.pi*np.outer(np.arange(N), np.arange(resolution))/N), axis=1)
+                        for N in fine_shape]
+        spectrum = np.tile(P, (resolution, resolution))
+        spectrum *= cell_spectra[0].astype(spectrum.dtype)[:, None]
+        spectrum *= cell_spectra[1].astype(spectrum.dtype)[None, :]
+        
+        return spectrum
+    
+    # place every native frequency at the same (signed) frequency of the fine grid, and shift by half a cell so that
+    # cell values land on the cell centres
+    spectrum = np.zeros(fine_shape, dtype=surface_pressure.dtype)
+    shift = (resolution - 1)/2
+    frequencies = [np.fft.fftfreq(N, 1/N).astype(int) for N in surface_pressure.shape]
+    shifts = [resolution*np.exp(-2j*np.pi*u*shift/N) for u, N in zip(frequencies, fine_shape)]
+    spectrum[np.ix_(frequencies[0] % fine_shape[0], frequencies[1] % fine_shape[1])] = P*np.outer(*shifts)
+    
+    return spectrum
+
+
+def ASM_prop(surface_pressure, cell_spacing, target_dist, resolution, k, precision=None, upsampling="kron"):
     """
     Propagate complex pressure forward to a parallel plane at a given resolution.
     Returns a complex pressure field.
@@ -81,24 +242,83 @@ def ASM_prop(surface_pressure, cell_spacing, target_dist, resolution, k):
         target_dist: distance to propagation plane
         resolution: returns this many sample points for each point in the input phasemap
         k: wavenumber
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        upsampling: ("kron") "kron", "spectral" (same result as "kron" for a fraction of the memory and time) or
+        "bandlimited", see "ASM_upsampled_spectrum".
     
     returns:
         
     """
-    f = np.kron(surface_pressure, np.ones((resolution, resolution)))
-    Nfft = f.shape
-    kx = (2*np.pi*(np.arange(-Nfft[0]/2, (Nfft[0])/2)/((cell_spacing/resolution)*Nfft[0]))).reshape((1, Nfft[0])) # kx vector
-    ky = (2*np.pi*(np.arange(-Nfft[1]/2, (Nfft[1])/2)/((cell_spacing/resolution)*Nfft[1]))).reshape((1, Nfft[1])) # ky vector
-    F = np.fft.fft2(f) # 2D FT
-    F = np.fft.fftshift(F) # Shift to the centre
-    ## Propagate forwards    
-    H = np.exp(1j*np.lib.scimath.sqrt(k**2 - kx**2 - (ky**2).T)*target_dist) # propagator function
-    Gf = F*H.T # propagating the signal forward in Fourier space
-    gf = np.fft.ifft2(np.fft.ifftshift(Gf)) # IFT & shift to return to real space
+    Gf = ASM_upsampled_spectrum(surface_pressure, resolution, upsampling, precision) # 2D FT
+    H = ASM_plan(Gf.shape, cell_spacing/resolution, target_dist, k, "forward", precision) # propagator function
+    Gf *= H # propagating the signal forward in Fourier space
+    gf = ifft2(Gf, out=Gf, overwrite_input=True) # IFT to return to real space
     return gf
     
     
-def ASM_prop_perpendicular(surface_pressure, cell_spacing, target_dist, z_height, cut_axis, resolution, k):
+def ASM_prop_volume(surface_pressure, cell_spacing, z_values, resolution, k, cut_axis=None, cut_index=None,
+                    chunk_length=16, precision=None, upsampling="kron"):
+    
+    """
+    
+    Propagate complex pressure forward to a stack of parallel planes at a given resolution. The source is
+    transformed once and the propagator is broadcast over chunks of z, so the cost of each extra plane is one
+    multiplication and one inverse FFT. When only an x or y slice is wanted, that single row or column of each
+    plane is found directly from the spectrum instead of with a full inverse FFT.
+    
+    args:
+        surface_pressure: complex surface pressure.
+        cell_spacing: seperation between cells on the metasurface [m].
+        z_values: distances of the propagation planes [m].
+        resolution: returns this many sample points for each point in the input phasemap.
+        k: wavenumber.
+        cut_axis: None to return every plane, "x" to keep one row of each plane or "y" to keep one column.
+        cut_index: index of the row or column to keep, defaults to the centre of the plane.
+        chunk_length: (16) number of planes propagated at once.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        upsampling: ("kron") "kron", "spectral" or "bandlimited", see "ASM_upsampled_spectrum".
+        
+    returns:
+        volume: complex pressure, shaped (z, N0, N1) for the full volume, (z, N1) for an x cut or (z, N0) for a
+        y cut, where N0, N1 are the shape of the surface pressure times the resolution.
+    
+    """
+    
+    if cut_axis not in (None, "x", "y"):
+        print(cut_axis, "is not a valid axis, please enter 'x' or 'y'.")
+        return
+    
+    F = ASM_upsampled_spectrum(surface_pressure, resolution, upsampling, precision) # 2D FT, done once for every plane
+    kz = ASM_kz(F.shape, float(cell_spacing/resolution), float(k), get_precision(precision))
+    z_values = np.asarray(z_values, dtype=real_dtype(precision))
+    
+    if cut_axis is not None:
+        
+        # inverse DFT weights which pick out a single row (x cut) or column (y cut) of each plane
+        axis = 0 if cut_axis == "x" else 1
+        cut_index = int(F.shape[axis]/2) if cut_index is None else cut_index
+        cut_weights = (np.exp(2j*np.pi*np.arange(F.shape[axis])*cut_index/F.shape[axis])/F.shape[axis]).astype(F.dtype)
+        volume = np.empty((len(z_values), F.shape[1 - axis]), dtype=F.dtype)
+        
+    else:
+        volume = np.empty((len(z_values),) + F.shape, dtype=F.dtype)
+    
+    for start in range(0, len(z_values), chunk_length):
+        
+        z_chunk = z_values[start:start + chunk_length]
+        Gf = F*np.exp(1j*kz*z_chunk[:, None, None]) # propagate the signal to every plane in the chunk
+        
+        if cut_axis == "x":
+            ifft(np.einsum("u,zuv->zv", cut_weights, Gf), out=volume[start:start + len(z_chunk)], overwrite_input=True)
+        elif cut_axis == "y":
+            ifft(np.einsum("v,zuv->zu", cut_weights, Gf), out=volume[start:start + len(z_chunk)], overwrite_input=True)
+        else:
+            ifft2(Gf, out=volume[start:start + len(z_chunk)], overwrite_input=True)
+            
+    return volume
+    
+    
+def ASM_prop_perpendicular(surface_pressure, cell_spacing, target_dist, z_height, cut_axis, resolution, k, precision=None):
     """
     Propagate complex pressure forward to a perpendicular plane at a given resolution.
     Returns a complex pressure field.
@@ -111,35 +331,205 @@ def ASM_prop_perpendicular(surface_pressure, cell_spacing, target_dist, z_height
         cut_axis; are we slicing in the x or y axes?
         resolution: returns this many sample points for each point in the input phasemap.
         k: wavenumber
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
         
     returns:
         
     """
-    if cut_axis == "x":
-        centrepoint = int(surface_pressure.shape[0]*resolution/2)
-        
-    elif cut_axis == "y":
-        centrepoint = int(surface_pressure.shape[1]*resolution/2)
-        
-    else:
+    if cut_axis not in ("x", "y"):
         print(cut_axis, "is not a valid axis, please enter 'x' or 'y'.")
         return 
     
     step = cell_spacing/resolution
     prop_range = np.arange(0, z_height + step, step)
-    xy_pressure_list = []
-    for target_dist in prop_range:
-        propagation = ASM_prop(surface_pressure, cell_spacing, target_dist, resolution, k)
-        if cut_axis == "x":
-            central_abs_pressure_vector = abs(propagation)[centrepoint]
-        elif cut_axis == "y":
-            central_abs_pressure_vector = abs(propagation.T)[centrepoint]
-        xy_pressure_list.append(central_abs_pressure_vector)
+    xy_pressure = abs(ASM_prop_volume(surface_pressure, cell_spacing, prop_range, resolution, k, cut_axis,
+                                      precision=precision))
 
-    return np.flipud(np.array(xy_pressure_list))
+    return np.flipud(xy_pressure)
     
     
-def ASM_Iterative_GS(target_image, incident_surface_pressure, iterations, cell_spacing, target_dist, k):
+def ASM_prop_points(surface_pressure, cell_spacing, points, k, surface_centre=(0, 0, 0), target_dist=None, method="auto",
+                    padding="adaptive", max_angle=80, eps=1e-9, mode_tol=1e-12, max_memory=2**28, precision=None):
+    
+    """
+    
+    evaluates the ASM field of a surface at arbitrary points in front of it, e.g. xz, yz or rotated planes built by
+    functions.points_vector_builder, without building a GF propagator. The surface is zero-padded for target_dist
+    (as in "ASM_Iterative_GS"), and its band-limited angular spectrum is summed at each point,
+    p(x, y, z) = sum A(kx, ky)*exp(1j*(kx*x + ky*y + kz*z)). For points on a parallel grid at target_dist this gives
+    the same field as the band-limited "ASM_fw" of the padded surface. The window and the band limit depend only on
+    the surface and target_dist, so the pressure at a point does not depend on which other points are evaluated
+    (beyond the evanescent waves left out below mode_tol).
+    
+    The sum is a type-3 non-uniform FFT, which is used if finufft is installed. Otherwise (or with method="direct")
+    it is done directly over chunks of points. Evanescent waves which have decayed below mode_tol at the closest
+    point are left out.
+    
+    args:
+        surface_pressure: complex surface pressure (N0, N1), surface_pressure[i, j] being the pressure at
+        x = x_j, y = y_i (the layout of a field from points_vector_builder reshaped to (N0, N1)).
+        cell_spacing: seperation between cells on the metasurface [m].
+        points: (P, 3) array of x, y, z coords of the evaluation points, all with z >= the z of the surface [m].
+        k: wavenumber.
+        surface_centre: ((0, 0, 0) [m]) coords of the centre of the surface, which lies in an xy plane.
+        target_dist: distance [m] the window is padded and band-limited for (see "ASM_padding"). Points further away
+        than this are still evaluated, but waves may wrap around onto them. Defaults to the distance at which the
+        adaptive padding reaches one aperture either side, beyond which it grows no further. Every point must lie
+        within the padded window.
+        method: ("auto") "nufft" (needs finufft), "direct", or "auto" to use "nufft" when finufft is installed.
+        padding: ("adaptive") "adaptive" or "fixed" padding against wrap-around, see "ASM_padding".
+        max_angle: (80 [deg]) steepest propagation angle kept clear of wrap-around by the adaptive padding.
+        eps: (1e-9) requested relative accuracy of the non-uniform FFT.
+        mode_tol: (1e-12) evanescent waves decaying below this factor at the closest point are left out.
+        max_memory: (2**28 [bytes]) memory budget for the chunks of the direct sum.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        
+    returns:
+        pressure: complex pressure at each point (P).
+    
+    """
+    
+    if method not in ("auto", "nufft", "direct"):
+        raise ValueError(str(method) + " is not a valid method, please specify 'auto', 'nufft' or 'direct'.")
+    
+    if method == "auto":
+        try:
+            import finufft
+            method = "nufft"
+        except ImportError:
+            method = "direct"
+    
+    from fft_functions import next_fast_len
+    
+    real, complex_ = real_dtype(precision), complex_dtype(precision)
+    surface_pressure = np.asarray(surface_pressure, dtype=complex_)
+    apsize = surface_pressure.shape
+    
+    # coords of the points relative to the first cell of the surface (x along axis 1, y along axis 0)
+    points = np.asarray(points, dtype=float).reshape(-1, 3) - np.asarray(surface_centre, dtype=float)
+    x, y, z = points[:, 0], points[:, 1], points[:, 2]
+    
+    if np.any(z < 0):
+        raise ValueError("every point must lie in front of the surface (z >= the z of the surface).")
+    
+    if target_dist is None:
+        theta = min(np.arcsin(min(1, np.pi/(k*cell_spacing))), np.radians(max_angle))
+        target_dist = max(apsize)*cell_spacing/np.tan(theta)
+    
+    # pad each axis against wrap-around. Lengths are kept even, where the frequencies of "ASM_kz" are the FFT
+    # frequencies
+    pw = ASM_padding(apsize, cell_spacing, target_dist, k, max_angle, padding)
+    padded_shape = []
+    for axis in range(2):
+        M = next_fast_len(apsize[axis] + sum(pw[axis]))
+        while M % 2:
+            M = next_fast_len(M + 1)
+        padded_shape.append(M)
+    
+    # centre the surface in the window, the first sample of the window then sits at origin
+    corner = [(M - N) // 2 for M, N in zip(padded_shape, apsize)]
+    origin = [-(c + (N - 1)/2)*cell_spacing for c, N in zip(corner, apsize)]
+    
+    # beyond the window the sum gives a periodic image of the field rather than the field
+    for offsets, start, M in zip((y, x), origin, padded_shape):
+        if np.any(offsets < start) or np.any(offsets > start + (M - 1)*cell_spacing):
+            raise ValueError("every point must lie within the padded window, increase target_dist to widen it.")
+    padded = np.zeros(padded_shape, dtype=complex_)
+    padded[corner[0]:corner[0] + apsize[0], corner[1]:corner[1] + apsize[1]] = surface_pressure
+    
+    # angular spectrum, with the normalisation of the inverse FFT folded in
+    A = fft2(padded).astype(complex_, copy=False) / (padded_shape[0]*padded_shape[1])
+    ky = 2*np.pi*np.fft.fftfreq(padded_shape[0], cell_spacing)
+    kx = 2*np.pi*np.fft.fftfreq(padded_shape[1], cell_spacing)
+    kz = np.lib.scimath.sqrt(k**2 - ky[:, None]**2 - kx[None, :]**2)
+    
+    # band limit of "ASM_plan_builder" for target_dist
+    ky_limit, kx_limit = [k/np.sqrt((2*target_dist/(M*cell_spacing))**2 + 1) for M in padded_shape]
+    band = (abs(ky[:, None]) < ky_limit) & (abs(kx[None, :]) < kx_limit)
+    
+    # propagating waves, and the evanescent waves which still matter at the closest point
+    modes = np.nonzero(band & (A != 0) & (np.exp(-kz.imag*z.min()) > mode_tol))
+    A, ky, kx, kz = A[modes], ky[modes[0]], kx[modes[1]], kz[modes]
+    
+    # move the phase reference from the window origin to the centre
+    A = (A*np.exp(-1j*(ky*origin[0] + kx*origin[1]))).astype(complex_, copy=False)
+    
+    propagating = kz.imag == 0
+    pressure = np.zeros(len(points), dtype=complex_)
+    
+    if method == "nufft":
+        
+        import finufft
+        
+        # propagating waves have real kz, so they are a type-3 transform from (kx, ky, kz) to (x, y, z)
+        pressure += finufft.nufft3d3(kx[propagating].astype(real), ky[propagating].astype(real),
+                                     kz[propagating].real.astype(real), A[propagating], x.astype(real),
+                                     y.astype(real), z.astype(real), eps=eps, isign=1)
+        A, ky, kx, kz = A[~propagating], ky[~propagating], kx[~propagating], kz[~propagating]
+    
+    # direct sum over chunks of points (of every mode, or only of the evanescent ones after the NUFFT)
+    if len(A) > 0:
+        
+        chunk_length = max(1, int(max_memory / (3*16*len(A))))
+        
+        for start in range(0, len(points), chunk_length):
+            stop = start + chunk_length
+            phase = np.outer(x[start:stop], kx) + np.outer(y[start:stop], ky)
+            waves = np.exp(1j*phase)*np.exp(1j*np.outer(z[start:stop], kz))
+            pressure[start:stop] += waves.astype(complex_, copy=False) @ A
+    
+    return pressure
+    
+    
+def ASM_padding(apsize, cell_spacing, target_dist, k, max_angle=80, padding="adaptive"):
+    
+    """
+    
+    finds how much to zero-pad an aperture on each side so that the circular convolution of the FFT does not wrap
+    the field around onto itself. Along each axis the field can spread by target_dist*tan(theta) either side of the
+    aperture, where theta is the steepest angle the grid can sample (sin(theta) = wavelength/(2*cell_spacing)),
+    capped at max_angle. The padding never exceeds one aperture either side (the fixed 3x padding), as the
+    band-limited propagator removes the steeper waves which could still wrap around. The adaptive padded lengths are
+    rounded up to even fast FFT lengths, as the frequencies of "ASM_kz" are only the FFT frequencies for even
+    lengths.
+    
+    args:
+        apsize: (N0, N1) shape of the aperture.
+        cell_spacing: seperation between cells on the metasurface [m].
+        target_dist: distance to propagation plane [m].
+        k: wavenumber.
+        max_angle: (80 [deg]) steepest propagation angle which is kept clear of wrap-around.
+        padding: ("adaptive") "adaptive", or "fixed" to pad every axis to 3 times its length (the padding used before
+        adaptive padding was added).
+        
+    returns:
+        pw: ((before, after), (before, after)) padding widths, as used by np.pad.
+    
+    """
+    
+    if padding not in ("adaptive", "fixed"):
+        raise ValueError(str(padding) + " is not a valid padding, please specify either 'adaptive' or 'fixed'.")
+    
+    from fft_functions import next_fast_len
+    
+    theta = min(np.arcsin(min(1, np.pi/(k*cell_spacing))), np.radians(max_angle))
+    spread = int(np.ceil(abs(target_dist)*np.tan(theta)/cell_spacing))
+    
+    pw = []
+    for N in apsize:
+        if padding == "fixed":
+            padded_length = 3*N
+        else:
+            padded_length = next_fast_len(N + 2*min(spread, N))
+            while padded_length % 2:
+                padded_length = next_fast_len(padded_length + 1)
+        pw.append(((padded_length - N) // 2, padded_length - N - (padded_length - N) // 2))
+        
+    return tuple(pw)
+
+
+def ASM_Iterative_GS(target_image, incident_surface_pressure, iterations, cell_spacing, target_dist, k, precision=None,
+                     padding="adaptive", max_angle=80):
     
     """
     
@@ -153,33 +543,183 @@ def ASM_Iterative_GS(target_image, incident_surface_pressure, iterations, cell_s
         cell_spacing: seperation between cells on the metasurface [m].
         target_dist: distance to propagation plane [m].
         k: wavenumber.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        padding: ("adaptive") "adaptive" pads each axis by the distance the field can spread (see "ASM_padding"),
+        which gives much smaller FFTs for short throws, and uses the band-limited propagator against the steeper
+        waves. "fixed" pads each axis to 3 times its length with the full propagator, as before adaptive padding was
+        added (the results for square apertures are the same as then).
+        max_angle: (80 [deg]) steepest propagation angle kept clear of wrap-around by the adaptive padding.
         
     returns:
         lpp: complex pressure map at the lens plane.
         
     """
     
-    apsize = target_image.shape
-    N = 3*apsize[0]
-    pw = ((int((N - apsize[0]) / 2), int((N - apsize[0]) / 2)),
-          (int((N - apsize[1]) / 2), int((N - apsize[1]) / 2)))
-    surface_amplitude, surface_phase = abs(incident_surface_pressure), np.angle(incident_surface_pressure)
-    aperture = ((surface_amplitude != 0).astype(int))
+    return ASM_Iterative_GS_batch(np.asarray(target_image)[np.newaxis], incident_surface_pressure, iterations, cell_spacing,
+                                  target_dist, k, precision, padding, max_angle)[0]
+
+
+def ASM_Iterative_GS_batch(target_images, incident_surface_pressure, iterations, cell_spacing, target_dist, k,
+                           precision=None, padding="adaptive", max_angle=80, workers=1, chunk_length=None):
     
-    padded_target = np.pad(target_image, pw, 'constant', constant_values = 0) # Pad with zeros 
+    """
+    
+    "ASM_Iterative_GS" for a stack of targets (e.g. from functions.target_builder_chars) which share the same source
+    and target distance. The targets are solved together, so every iteration is one batched FFT using one cached
+    propagation plan. Large stacks can be split into chunks and solved in parallel processes.
+    
+    args:
+        target_images: (B, N0, N1) stack (or list) of normalised target images (all elems should be 0-1).
+        incident_surface_pressure: the complex pressure from the source incident on the metasurface (N0, N1).
+        iterations: number of iterations for the algorithm to run (normally asymptotes ~200).
+        cell_spacing: seperation between cells on the metasurface [m].
+        target_dist: distance to propagation plane [m].
+        k: wavenumber.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        padding: ("adaptive") "adaptive" or "fixed", see "ASM_Iterative_GS".
+        max_angle: (80 [deg]) steepest propagation angle kept clear of wrap-around by the adaptive padding.
+        workers: (1) number of processes. If more than 1, the stack is split into chunks which are solved in a
+        process pool. The processes use the current precision and FFT backend, each with cores/workers FFT threads
+        unless a thread count was set with fft_functions.set_fft_backend.
+        chunk_length: largest number of targets solved together, which bounds the memory used. Defaults to the whole
+        stack, or to an even split between the workers.
+        
+    returns:
+        lpps: (B, N0, N1) complex pressure maps at the lens plane, one per target.
+        
+    """
+    
+    target_images = np.asarray(target_images)
+    batch = target_images.shape[0]
+    
+    if chunk_length is None:
+        chunk_length = int(np.ceil(batch / workers))
+    
+    if batch > chunk_length:
+        
+        # settings are resolved here, as processes which are spawned rather than forked start from the defaults
+        chunks = [target_images[start:start + chunk_length] for start in range(0, batch, chunk_length)]
+        args = (incident_surface_pressure, iterations, cell_spacing, target_dist, k, get_precision(precision), padding,
+                max_angle)
+        
+        if workers > 1:
+            
+            import concurrent.futures
+            from fft_functions import fft_settings, set_fft_backend
+            
+            # the cores are shared out between the processes unless an FFT thread count was set
+            fft_workers = max(1, os.cpu_count() // workers) if fft_settings["workers"] == -1 else fft_settings["workers"]
+            initargs = (fft_settings["backend"], fft_workers, fft_settings["planner_effort"])
+            
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=set_fft_backend,
+                                                        initargs=initargs) as executor:
+                lpps = list(executor.map(ASM_Iterative_GS_batch, chunks, *[[arg]*len(chunks) for arg in args]))
+        else:
+            lpps = [ASM_Iterative_GS_batch(chunk, *args) for chunk in chunks]
+            
+        return np.concatenate(lpps, axis=0)
+    
+    apsize = target_images.shape[1:]
+    pw = ASM_padding(apsize, cell_spacing, target_dist, k, max_angle, padding)
+    real = real_dtype(precision)
+    surface_amplitude = abs(incident_surface_pressure).astype(real)
+    aperture = ((surface_amplitude != 0).astype(real))
+    
+    padded_targets = np.pad(np.asarray(target_images, dtype=real), ((0, 0),) + pw, 'constant', constant_values = 0) # Pad with zeros 
     padded_aperture = np.pad(aperture, pw, 'constant', constant_values = 0)
     padded_surface_amplitude = np.pad(surface_amplitude, pw, 'constant', constant_values = 0)
     
-    tpp = padded_target*np.exp(1j*padded_target*np.pi) # initial pressure at target plane
+    tpp = padded_targets*np.exp(1j*padded_targets*np.pi) # initial pressure at target plane
+    
+    # only the adaptive padding relies on the band limit against wrap-around
+    band_limit = padding == "adaptive"
+    
+    # the FFT output of every iteration is written into the same two buffers
+    lpp_buffer, tpp_buffer = np.empty(tpp.shape, dtype=complex_dtype(precision)), np.empty(tpp.shape, dtype=complex_dtype(precision))
     
     for it in range(iterations):
-        lpp = ASM_bw(tpp, cell_spacing, target_dist, k) # inverse ASM to backpropagate complex pressure to lens-plane
+        lpp = ASM_bw(tpp, cell_spacing, target_dist, k, precision, out=lpp_buffer, band_limit=band_limit) # inverse ASM to backpropagate complex pressure to lens-plane
+        lpp = padded_surface_amplitude*np.exp(1j*np.angle(lpp)*padded_aperture) # isolate over aperture
+        tpp = ASM_fw(lpp, cell_spacing, target_dist, k, precision, out=tpp_buffer, band_limit=band_limit) # forward ASM to propagate updated phase as complex pressure to the target-plane
+        tpp = padded_targets*np.exp(1j*np.angle(tpp)*padded_targets) # isolate target area
+        
+    lpp = ASM_bw(tpp, cell_spacing, target_dist, k, precision, band_limit=band_limit)
+    lpp = padded_aperture*np.exp(1j*np.angle(lpp)*padded_aperture) # isolate
+    
+    return lpp[:, pw[0][0]:pw[0][0] + apsize[0], pw[1][0]:pw[1][0] + apsize[1]]
+
+
+def ASM_Iterative_GS_multiplane(target_images, incident_surface_pressure, iterations, cell_spacing, target_dists, k,
+                                precision=None, padding="adaptive", max_angle=80, plane_weights=None):
+    
+    """
+    
+    GS algorithm for several target planes at once, each with its own image and distance, so that one phasemap
+    forms every image. Each iteration propagates the surface to every plane with one FFT and one batched inverse FFT
+    (one cached propagation plan per plane), imposes each target amplitude, then backpropagates the planes and
+    averages their contributions at the surface (the "global" GS update).
+    
+    args:
+        target_images: (L, N0, N1) stack (or list) of normalised target images (all elems should be 0-1), one per plane.
+        incident_surface_pressure: the complex pressure from the source incident on the metasurface (N0, N1).
+        iterations: number of iterations for the algorithm to run (normally asymptotes ~200).
+        cell_spacing: seperation between cells on the metasurface [m].
+        target_dists: distances to the L propagation planes [m].
+        k: wavenumber.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        padding: ("adaptive") "adaptive" or "fixed", see "ASM_Iterative_GS". The furthest plane sets the padding.
+        max_angle: (80 [deg]) steepest propagation angle kept clear of wrap-around by the adaptive padding.
+        plane_weights: relative weight of each plane in the surface update, defaults to equal weights.
+        
+    returns:
+        lpp: complex pressure map at the lens plane.
+        
+    """
+    
+    target_images = np.asarray(target_images)
+    target_dists = np.ravel(target_dists)
+    
+    if len(target_dists) != len(target_images):
+        raise ValueError("there must be one target distance for every target image.")
+    
+    apsize = target_images.shape[1:]
+    pw = ASM_padding(apsize, cell_spacing, np.abs(target_dists).max(), k, max_angle, padding)
+    real = real_dtype(precision)
+    surface_amplitude = abs(incident_surface_pressure).astype(real)
+    aperture = ((surface_amplitude != 0).astype(real))
+    
+    padded_targets = np.pad(np.asarray(target_images, dtype=real), ((0, 0),) + pw, 'constant', constant_values = 0) # Pad with zeros 
+    padded_aperture = np.pad(aperture, pw, 'constant', constant_values = 0)
+    padded_surface_amplitude = np.pad(surface_amplitude, pw, 'constant', constant_values = 0)
+    
+    # one forward and one backward plan per plane, stacked so that every plane is propagated in one batched product
+    # (band-limited with the adaptive padding, as in "ASM_Iterative_GS")
+    band_limit = padding == "adaptive"
+    H = np.stack([ASM_plan(padded_aperture.shape, cell_spacing, z, k, "forward", precision, band_limit) for z in target_dists])
+    Hb = np.stack([ASM_plan(padded_aperture.shape, cell_spacing, z, k, "backward", precision, band_limit) for z in target_dists])
+    
+    if plane_weights is not None:
+        plane_weights = np.asarray(plane_weights, dtype=real)
+        Hb = Hb*(plane_weights/plane_weights.mean())[:, None, None]
+    
+    tpp = padded_targets*np.exp(1j*padded_targets*np.pi) # initial pressure at each target plane
+    
+    for it in range(iterations + 1):
+        
+        # backpropagate every plane and average their spectra, so only one inverse FFT is needed
+        Gb = fft2(tpp.astype(H.dtype, copy=False))
+        Gb *= Hb
+        lpp = ifft2(np.mean(Gb, axis=0), overwrite_input=True)
+        
+        if it == iterations:
+            break
+        
         lpp = padded_surface_amplitude*np.exp(1j*np.angle(lpp)*padded_aperture) # isolate over aperture
-        tpp = ASM_fw(lpp, cell_spacing, target_dist, k) # forward ASM to propagate updated phase as complex pressure to the target-plane
-        tpp = padded_target*np.exp(1j*np.angle(tpp)*padded_target) # isolate target area
         
-    lpp = ASM_bw(tpp, cell_spacing, target_dist, k)
+        # propagate the surface to every plane: one FFT, then one batched inverse FFT
+        tpp = ifft2(fft2(lpp.astype(H.dtype, copy=False))*H, overwrite_input=True)
+        tpp = padded_targets*np.exp(1j*np.angle(tpp)*padded_targets) # isolate target areas
+        
     lpp = padded_aperture*np.exp(1j*np.angle(lpp)*padded_aperture) # isolate
-    tpp = ASM_fw(lpp, cell_spacing, target_dist, k)
     
-    return lpp[pw[0][0]:pw[0][0] + apsize[0], pw[1][0]:pw[1][0] + apsize[1]]
\ No newline at end of file
+    return lpp[pw[0][0]:pw[0][0] + apsize[0], pw[1][0]:pw[1][0] + apsize[1]]
@@ -1,14 +1,17 @@
 import os
 import time
+import threading
+import concurrent.futures
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import itertools as it
 import math as math
 from scipy.special import comb
+from functions import chunked_dot, real_dtype, complex_dtype
 
 
-def GF_propagator_function_builder(reflector_points, eval_points, normals, areas, k):
+def GF_propagator_function_builder(reflector_points, eval_points, normals, areas, k, precision=None):
     
     """
     
@@ -23,16 +26,20 @@ def GF_propagator_function_builder(reflector_points, eval_points, normals, areas
         normals: for a flat metasurface you get n*m times the vector [0, 0, 1].
         area: vector of the areas covered by each element (1, n*m).
         k: wavenumber.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
         
 
     returns:
         H: Gives distance matrix of all distances between reflector and evaluation points (n*m, p*q).
         
     """
+    real = real_dtype(precision)
+    
     # assign variables for x, y and z coord vectors for reflectors, evaluation points and normals
-    rp_x, rp_y, rp_z = reflector_points.T
-    ep_x, ep_y, ep_z = eval_points.T
-    nm_x, nm_y, nm_z = normals
+    rp_x, rp_y, rp_z = np.asarray(reflector_points, dtype=real).T
+    ep_x, ep_y, ep_z = np.asarray(eval_points, dtype=real).T
+    nm_x, nm_y, nm_z = [np.asarray(normal, dtype=real) for normal in normals]
+    areas, k = np.asarray(areas, dtype=real), real.type(k)
     
     # compute distances between eval_points and reflecting elements
     r = np.sqrt((rp_x.reshape(-1, 1) - ep_x.reshape(1, -1))**2 + \
@@ -53,10 +60,10 @@ def GF_propagator_function_builder(reflector_points, eval_points, normals, areas
     # include reflector areas to build propagator function H
     H = g * areas.T
     
-    return H
+    return H.astype(complex_dtype(precision), copy=False)
 
 
-def GF_prop(complex_pressure, H, prop_direction):
+def GF_prop(complex_pressure, H, prop_direction, max_memory=2**28):
     
     """
     
@@ -65,22 +72,27 @@ def GF_prop(complex_pressure, H, prop_direction):
     args:
         complex_pressure: The complex pressure matrix at our source plane. For forward propagation,
         this is the pressure on the reflective surface, for backwards propagation this it the pressure at
-        the target.
-        H: the propagator function defined using "GF_propagator_function_builder" 
+        the target. A stack of pressures, shaped (batch, elements), is propagated in chunked matrix-matrix products.
+        H: the propagator function defined using "GF_propagator_function_builder", or a compressed propagator from
+        "GF_compressed_propagator_builder".
         prop_direction: direction of propagation ("forward" or "backward").
+        max_memory: (2**28 [bytes]) memory budget for the output of each chunk when propagating a stack of pressures.
         
     returns:
-        complex pressure matrix at the evaluation plane.
+        complex pressure matrix at the evaluation plane, shaped (batch, p*q) for a stack of pressures.
     
     """
     
+    # keep the pressure in the precision of the propagator
+    complex_pressure = np.asarray(complex_pressure, dtype=np.result_type(H.dtype, np.complex64))
+    
     # forward propagate from AMM plane to evaluation plane
     if prop_direction == "forward":
-        return 2 * np.dot(complex_pressure, H) 
+        return 2 * chunked_dot(complex_pressure, H, max_memory) 
     
     # backward propagate from evaluation plane to AMM
     elif prop_direction == "backward":
-        return 2 * np.dot(complex_pressure, np.conj(H)) 
+        return 2 * chunked_dot(complex_pressure, H.conj(), max_memory) 
     
     else:
         print(prop_direction, "is not a valid propagation direction, please specifiy either 'forward' or 'backward'.")
@@ -90,6 +102,10 @@ def GF_prop(complex_pressure, H, prop_direction):
 
 def GFGS(H, incident_surface_pressure, abs_target, iterations=50, verbose=False):
 
+    # keep the pressures in the precision of the propagator
+    abs_target = np.asarray(abs_target, dtype=np.finfo(H.dtype).dtype)
+    incident_surface_pressure = np.asarray(incident_surface_pressure, dtype=H.dtype)
+
     # initialise - target plane pressure
     tpp = abs_target*np.exp(1j*np.pi*abs_target)
 
@@ -97,13 +113,13 @@ def GFGS(H, incident_surface_pressure, abs_target, iterations=50, verbose=False)
     for it in range(iterations):
 
         # backpropagate to find surface plane pressure
-        spp = np.dot(np.conj(H), tpp)
+        spp = H.conj() @ tpp
 
         # reset amplitude on the surface
         spp = abs(incident_surface_pressure).reshape(-1, 1)*np.exp(1j*np.angle(spp))
 
         # propagate back to target plane
-        tpp = np.dot(H.T, spp)
+        tpp = H.T @ spp
 
         # isolate over the target area
         tpp = abs_target*np.exp(1j*np.angle(tpp)*abs_target)
@@ -112,7 +128,743 @@ def GFGS(H, incident_surface_pressure, abs_target, iterations=50, verbose=False)
             print("Iteration:", str(it), "... done!")
 
     # finalise
-    spp = np.dot(np.conj(H), tpp)
+    spp = H.conj() @ tpp
     spp = incident_surface_pressure.reshape(-1, 1)*np.exp(1j*np.angle(spp))
     
-    return spp
\ No newline at end of file
+    return spp
+
+def GF_tile_length(num_reflectors, max_memory=2**28, bytes_per_element=96):
+    
+    """
+    
+    find how many evaluation points can be propagated at once without exceeding a memory budget.
+    
+    args:
+        num_reflectors: number of reflecting elements (n*m).
+        max_memory: (2**28 [bytes]) memory budget for a single tile of the propagator and its temporaries.
+        bytes_per_element: (96 [bytes]) memory used per reflector/evaluation point pair while building a tile,
+        i.e. one float64 distance plus several complex128 temporaries.
+        
+    returns:
+        tile_length: number of evaluation points per tile (at least 1).
+    
+    """
+    
+    return max(1, int(max_memory // (bytes_per_element * num_reflectors)))
+
+
+def GF_prop_tiled(complex_pressure, reflector_points, eval_points, normals, areas, k, prop_direction, max_memory=2**28,
+                  precision=None):
+    
+    """
+    
+    matrix-free version of GF_prop. The propagator is built tile by tile over the evaluation points, so that only a
+    (n*m, tile_length) block of H is held in memory at any time. Gives the same result as building H with 
+    "GF_propagator_function_builder" and calling "GF_prop".
+    
+    args:
+        complex_pressure: complex pressure vector at the reflecting elements (n*m), or a stack of them (batch, n*m).
+        reflector_points: matrix of x,y,z coords for the reflecting elements.
+        eval_points: matrix of evaluation x,y,z coords at the propagation plane.
+        normals: for a flat metasurface you get n*m times the vector [0, 0, 1].
+        areas: vector of the areas covered by each element (1, n*m).
+        k: wavenumber.
+        prop_direction: direction of propagation ("forward" or "backward").
+        max_memory: (2**28 [bytes]) memory budget for each tile of the propagator.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        
+    returns:
+        complex pressure vector at the evaluation points (p*q), or (batch, p*q) for a stack of pressures.
+    
+    """
+    
+    if prop_direction not in ("forward", "backward"):
+        print(prop_direction, "is not a valid propagation direction, please specifiy either 'forward' or 'backward'.")
+        return
+    
+    tile_length = GF_tile_length(len(reflector_points), max_memory)
+    eval_pressure = np.zeros(np.shape(complex_pressure)[:-1] + (len(eval_points),), dtype=complex_dtype(precision))
+    
+    for start in range(0, len(eval_points), tile_length):
+        
+        stop = min(start + tile_length, len(eval_points))
+        
+        # build the block of H belonging to this tile of evaluation points
+        H_tile = GF_propagator_function_builder(reflector_points, eval_points[start:stop], normals, areas, k, precision)
+        
+        # propagate the whole surface onto this tile only
+        eval_pressure[..., start:stop] = GF_prop(complex_pressure, H_tile, prop_direction)
+        
+    return eval_pressure
+
+
+def GFGS_batch(H, incident_surface_pressure, abs_targets, max_iterations=200, tol=1e-4, patience=3, verbose=False):
+    
+    """
+    
+    batched version of GFGS. A stack of targets is solved at once using matrix-matrix products, and each target
+    stops iterating once its target-plane error has plateaued.
+    
+    args:
+        H: the propagator function defined using "GF_propagator_function_builder" (n*m, p*q), or a compressed
+        propagator from "GF_compressed_propagator_builder".
+        incident_surface_pressure: complex pressure incident on the surface (n*m).
+        abs_targets: (batch, p*q) stack of target amplitudes, or a single (p*q) target.
+        max_iterations: (200) maximum number of iterations for any target.
+        tol: (1e-4) relative change in target-plane error below which an iteration counts as a plateau.
+        patience: (3) number of consecutive plateaued iterations after which a target is stopped.
+        verbose: if True, print the number of targets still running at each iteration.
+        
+    returns:
+        spp: (batch, n*m) complex surface pressures.
+        history: dictionary of per-iteration telemetry:
+            "error": (iterations, batch) target-plane error, nan once a target has stopped.
+            "time": (iterations) wall time of each iteration [s].
+            "iterations": (batch) number of iterations run for each target.
+    
+    """
+    
+    # run in the precision of the propagator
+    real = np.finfo(H.dtype).dtype
+    abs_targets = np.atleast_2d(abs_targets).reshape(-1, H.shape[1]).T.astype(real)
+    incident_amplitude = abs(incident_surface_pressure).reshape(-1, 1).astype(real)
+    batch = abs_targets.shape[1]
+    
+    # the conjugate propagator is reused by every iteration, the transpose is only a view
+    H_conj, H_T = H.conj(), H.T
+    
+    # initialise - target plane pressure
+    tpp = abs_targets*np.exp(1j*np.pi*abs_targets)
+    
+    active = np.ones(batch, dtype=bool)
+    plateau_count = np.zeros(batch, dtype=int)
+    previous_error = np.full(batch, np.inf)
+    iterations = np.zeros(batch, dtype=int)
+    error_history, time_history = [], []
+    
+    for it in range(max_iterations):
+        
+        start_time = time.perf_counter()
+        targets = abs_targets[:, active]
+        
+        # backpropagate to find surface plane pressure, then reset amplitude on the surface
+        spp = H_conj @ tpp[:, active]
+        spp = incident_amplitude*np.exp(1j*np.angle(spp))
+        
+        # propagate back to target plane
+        active_tpp = H_T @ spp
+        
+        # target-plane error of the amplitudes, after the best fitting scale is applied
+        abs_tpp = abs(active_tpp)
+        scale = np.sum(abs_tpp*targets, axis=0)/np.maximum(np.sum(abs_tpp**2, axis=0), np.finfo(real).tiny)
+        error = np.linalg.norm(abs_tpp*scale - targets, axis=0)/np.linalg.norm(targets, axis=0)
+        
+        # isolate over the target area
+        tpp[:, active] = targets*np.exp(1j*np.angle(active_tpp)*targets)
+        
+        iteration_error = np.full(batch, np.nan)
+        iteration_error[active] = error
+        error_history.append(iteration_error)
+        time_history.append(time.perf_counter() - start_time)
+        iterations[active] += 1
+        
+        # stop each target independently once its error has plateaued
+        plateaued = abs(previous_error[active] - error) <= tol*error
+        plateau_count[active] = np.where(plateaued, plateau_count[active] + 1, 0)
+        previous_error[active] = error
+        active[active] = plateau_count[active] < patience
+        
+        if verbose:
+            print("Iteration:", str(it), "...", str(np.count_nonzero(active)), "of", str(batch), "targets running.")
+            
+        if not active.any():
+            break
+    
+    # finalise
+    spp = H_conj @ tpp
+    spp = incident_surface_pressure.reshape(-1, 1).astype(spp.dtype)*np.exp(1j*np.angle(spp))
+    
+    history = {"error": np.array(error_history), "time": np.array(time_history), "iterations": iterations}
+    
+    return spp.T, history
+
+
+def GF_geometry_builder(reflector_points, eval_points, normals, areas, precision=None):
+    
+    """
+    
+    builds the frequency independent parts of "GF_propagator_function_builder", so that they can be reused across a
+    frequency sweep. For any wavenumber k, H = exp(1j*k*r)*(1j*k*r - 1)*geometry.
+    
+    args:
+        reflector_points: matrix of x,y,z coords for the reflecting elements.
+        eval_points: matrix of evaluation x,y,z coords at the propagation plane.
+        normals: for a flat metasurface you get n*m times the vector [0, 0, 1].
+        areas: vector of the areas covered by each element (1, n*m).
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        
+    returns:
+        r: distance matrix between reflector and evaluation points (n*m, p*q).
+        geometry: normal projection, areas and 1/r**3 term of H (n*m, p*q). Coincident points are set to zero.
+    
+    """
+    
+    real = real_dtype(precision)
+    
+    # assign variables for x, y and z coord vectors for reflectors, evaluation points and normals
+    rp_x, rp_y, rp_z = np.asarray(reflector_points, dtype=real).T
+    ep_x, ep_y, ep_z = np.asarray(eval_points, dtype=real).T
+    nm_x, nm_y, nm_z = [np.asarray(normal, dtype=real) for normal in normals]
+    areas = np.asarray(areas, dtype=real)
+    
+    # compute distances between eval_points and reflecting elements
+    r = np.sqrt((rp_x.reshape(-1, 1) - ep_x.reshape(1, -1))**2 + \
+                (rp_y.reshape(-1, 1) - ep_y.reshape(1, -1))**2 + \
+                (rp_z.reshape(-1, 1) - ep_z.reshape(1, -1))**2)
+    
+    # equation 2.21 in the pdf, with the areas and the 1/r**3 of the partial of greens w.r.t normals
+    geometry = ((ep_x.reshape(1, -1) - rp_x.reshape(-1, 1)) * nm_x.T + \
+                (ep_y.reshape(1, -1) - rp_y.reshape(-1, 1)) * nm_y.T + \
+                (ep_z.reshape(1, -1) - rp_z.reshape(-1, 1)) * nm_z.T)
+    geometry *= -(1/(4*np.pi)) * areas.T
+    
+    # find coincident points and set them to zero.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        geometry /= r**3
+    geometry[r == 0] = 0
+    
+    return r, geometry
+
+
+def GF_propagator_sweep(reflector_points, eval_points, normals, areas, ks, precision=None):
+    
+    """
+    
+    generator over the propagators of a frequency sweep. The geometry is computed once, and only the wavenumber
+    dependent factor is evaluated for each k, so only one H is held in memory at a time.
+    
+    args:
+        reflector_points: matrix of x,y,z coords for the reflecting elements.
+        eval_points: matrix of evaluation x,y,z coords at the propagation plane.
+        normals: for a flat metasurface you get n*m times the vector [0, 0, 1].
+        areas: vector of the areas covered by each element (1, n*m).
+        ks: list of wavenumbers.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        
+    yields:
+        k, H: each wavenumber and its propagator function (n*m, p*q).
+    
+    """
+    
+    r, geometry = GF_geometry_builder(reflector_points, eval_points, normals, areas, precision)
+    
+    for k in ks:
+        
+        kr = real_dtype(precision).type(k) * r
+        H = np.exp(1j*kr)
+        H *= 1j*kr - 1
+        H *= geometry
+        
+        yield k, H
+
+
+def GF_prop_sweep(complex_pressures, reflector_points, eval_points, normals, areas, ks, prop_direction,
+                  max_memory=2**28, precision=None):
+    
+    """
+    
+    propagates a frequency sweep tile by tile over the evaluation points. The geometry of each tile is computed once
+    and reused for every wavenumber, so a sweep costs little more than a single "GF_prop_tiled".
+    
+    args:
+        complex_pressures: complex pressure at the reflecting elements, either one (n*m) vector used at every
+        frequency or a (frequencies, n*m) array with one vector per wavenumber.
+        reflector_points: matrix of x,y,z coords for the reflecting elements.
+        eval_points: matrix of evaluation x,y,z coords at the propagation plane.
+        normals: for a flat metasurface you get n*m times the vector [0, 0, 1].
+        areas: vector of the areas covered by each element (1, n*m).
+        ks: list of wavenumbers.
+        prop_direction: direction of propagation ("forward" or "backward").
+        max_memory: (2**28 [bytes]) memory budget for each tile of the geometry and propagator.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        
+    returns:
+        (frequencies, p*q) array of complex pressure at the evaluation points.
+    
+    """
+    
+    if prop_direction not in ("forward", "backward"):
+        print(prop_direction, "is not a valid propagation direction, please specifiy either 'forward' or 'backward'.")
+        return
+    
+    complex_pressures = np.broadcast_to(complex_pressures, (len(ks), len(reflector_points)))
+    tile_length = GF_tile_length(len(reflector_points), max_memory)
+    eval_pressure = np.zeros((len(ks), len(eval_points)), dtype=complex_dtype(precision))
+    
+    for start in range(0, len(eval_points), tile_length):
+        
+        stop = min(start + tile_length, len(eval_points))
+        tile_sweep = GF_propagator_sweep(reflector_points, eval_points[start:stop], normals, areas, ks, precision)
+        
+        for i, (k, H_tile) in enumerate(tile_sweep):
+            eval_pressure[i, start:stop] = GF_prop(complex_pressures[i], H_tile, prop_direction)
+            
+    return eval_pressure
+
+
+def GF_propagator_function_builder_threaded(reflector_points, eval_points, normals, areas, k, workers=None,
+                                            block_shape=(128, 1024), precision=None):
+    
+    """
+    
+    multi-threaded version of "GF_propagator_function_builder". H is split into blocks of reflector/evaluation
+    points which are shared across a thread pool. Each block is computed in a single pass of in-place ufuncs on
+    per-thread scratch buffers and written straight into H, so nothing is allocated per block.
+    NumPy releases the GIL inside these ufuncs, so the blocks run in parallel.
+    
+    args:
+        reflector_points: matrix of x,y,z coords for the reflecting elements.
+        eval_points: matrix of evaluation x,y,z coords at the propagation plane.
+        normals: for a flat metasurface you get n*m times the vector [0, 0, 1].
+        areas: vector of the areas covered by each element (1, n*m).
+        k: wavenumber.
+        workers: number of threads, defaults to the number of cores (os.cpu_count()).
+        block_shape: ((128, 1024)) number of (reflector, evaluation) points in each block.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        
+    returns:
+        H: propagator function (n*m, p*q). Coincident points are set to zero.
+    
+    """
+    
+    real = real_dtype(precision)
+    
+    rp_x, rp_y, rp_z = np.asarray(reflector_points, dtype=real).T
+    ep_x, ep_y, ep_z = np.asarray(eval_points, dtype=real).T
+    nm_x, nm_y, nm_z = [np.asarray(normal, dtype=real).reshape(-1) for normal in normals]
+    
+    # the constant of the partial of greens and the areas are folded into one factor per reflector
+    weights = np.asarray(areas, dtype=real).reshape(-1) / real.type(4*np.pi)
+    k = real.type(k)
+    
+    H = np.empty((len(rp_x), len(ep_x)), dtype=complex_dtype(precision))
+    scratch = threading.local()
+    
+    def build_block(rows, cols):
+        
+        # reuse this thread's buffers, viewed with the shape of the current block
+        if not hasattr(scratch, "buffers"):
+            scratch.buffers = np.empty((6, block_shape[0]*block_shape[1]), dtype=real)
+            scratch.mask = np.empty(block_shape[0]*block_shape[1], dtype=bool)
+        shape = (rows.stop - rows.start, cols.stop - cols.start)
+        d, r, proj, kr, c, s = [buffer[:shape[0]*shape[1]].reshape(shape) for buffer in scratch.buffers]
+        nonzero = scratch.mask[:shape[0]*shape[1]].reshape(shape)
+        
+        # squared distances and projection onto the normals, one axis at a time (kr is free until the phase)
+        for rp, ep, nm in ((rp_x, ep_x, nm_x), (rp_y, ep_y, nm_y), (rp_z, ep_z, nm_z)):
+            np.subtract(ep[None, cols], rp[rows, None], out=d)
+            if rp is rp_x:
+                np.multiply(d, nm[rows, None], out=proj)
+                np.multiply(d, d, out=r)
+            else:
+                np.multiply(d, nm[rows, None], out=kr)
+                proj += kr
+                np.multiply(d, d, out=kr)
+                r += kr
+        np.sqrt(r, out=r)
+        
+        # proj becomes the geometry factor (normal projection * area) / (4*pi*r**3)
+        proj *= weights[rows, None]
+        np.multiply(r, r, out=d)
+        d *= r
+        np.not_equal(r, 0, out=nonzero)
+        np.divide(proj, d, out=proj, where=nonzero)
+        np.copyto(proj, 0, where=np.logical_not(nonzero, out=nonzero))
+        
+        # -exp(1j*k*r)*(1j*k*r - 1) = (cos(kr) + kr*sin(kr)) + 1j*(sin(kr) - kr*cos(kr))
+        np.multiply(r, k, out=kr)
+        np.cos(kr, out=c)
+        np.sin(kr, out=s)
+        block = H[rows, cols]
+        np.multiply(kr, s, out=d)
+        d += c
+        np.multiply(d, proj, out=block.real)
+        np.multiply(kr, c, out=d)
+        np.subtract(s, d, out=d)
+        np.multiply(d, proj, out=block.imag)
+    
+    blocks = [(slice(i, min(i + block_shape[0], len(rp_x))), slice(j, min(j + block_shape[1], len(ep_x))))
+              for i in range(0, len(rp_x), block_shape[0]) for j in range(0, len(ep_x), block_shape[1])]
+    
+    # ThreadPoolExecutor's own default (min(32, cores + 4)) oversubscribes the cores
+    workers = os.cpu_count() if workers is None else workers
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda block: build_block(*block), blocks))
+        
+    return H
+
+
+def GF_regular_grid(points, rtol=1e-6):
+    
+    """
+    
+    detects whether a set of points is a regular xy grid, as built by "points_vector_builder" for a plane of
+    constant z (x varies fastest, then y).
+    
+    args:
+        points: matrix of x,y,z coords.
+        rtol: (1e-6) tolerance on the grid spacing, relative to the spacing.
+        
+    returns:
+        grid: dictionary with the "origin" (first point), "spacing" (dx, dy) and "shape" (ny, nx) of the grid,
+        or None if the points are not a regular xy grid.
+    
+    """
+    
+    points = np.asarray(points, dtype=float)
+    x, y, z = points.T
+    
+    # number of points in each row, i.e. before x wraps around
+    wraps = np.flatnonzero(np.diff(x) < 0)
+    nx = wraps[0] + 1 if len(wraps) else len(x)
+    if len(x) % nx != 0:
+        return None
+    ny = len(x) // nx
+    
+    xx, yy = x.reshape(ny, nx), y.reshape(ny, nx)
+    if nx == 1 and ny == 1:
+        return None
+    
+    # a single row or column takes the spacing of the other axis
+    dx = (xx[0, -1] - xx[0, 0])/(nx - 1) if nx > 1 else (yy[-1, 0] - yy[0, 0])/(ny - 1)
+    dy = (yy[-1, 0] - yy[0, 0])/(ny - 1) if ny > 1 else dx
+    if dx <= 0 or dy <= 0:
+        return None
+    
+    # every point must sit on the grid, in a single plane of constant z
+    expected_x = xx[0, 0] + dx*np.arange(nx)
+    expected_y = yy[0, 0] + dy*np.arange(ny)
+    tol = rtol*min(dx, dy)
+    if not (np.all(abs(xx - expected_x[None, :]) <= tol) and np.all(abs(yy - expected_y[:, None]) <= tol) and \
+            np.all(abs(z - z[0]) <= tol)):
+        return None
+    
+    return {"origin": points[0], "spacing": (dx, dy), "shape": (ny, nx)}
+
+
+def GF_prop_fft(complex_pressure, reflector_points, eval_points, normals, areas, k, prop_direction, precision=None):
+    
+    """
+    
+    propagates between two parallel, regular xy grids (see "GF_regular_grid") using a zero-padded FFT convolution.
+    When every element has the same normal and area, the GF kernel only depends on the offset between reflector and
+    evaluation points, so H is block-Toeplitz and GF_prop is a 2D convolution, costing O(N log N) instead of O(N*M).
+    The evaluation spacing may be an integer fraction (1/resolution) of the reflector spacing. Gives the same result
+    as "GF_prop" with the H from "GF_propagator_function_builder".
+    
+    args:
+        complex_pressure: complex pressure vector at the reflecting elements (n*m), or a stack of them (batch, n*m).
+        reflector_points: matrix of x,y,z coords for the reflecting elements.
+        eval_points: matrix of evaluation x,y,z coords at the propagation plane.
+        normals: for a flat metasurface you get n*m times the vector [0, 0, 1].
+        areas: vector of the areas covered by each element (1, n*m).
+        k: wavenumber.
+        prop_direction: direction of propagation ("forward" or "backward").
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        
+    returns:
+        complex pressure vector at the evaluation points (p*q), or (batch, p*q) for a stack of pressures.
+    
+    """
+    
+    from scipy.signal import fftconvolve
+    
+    if prop_direction not in ("forward", "backward"):
+        print(prop_direction, "is not a valid propagation direction, please specifiy either 'forward' or 'backward'.")
+        return
+    
+    resolution, reflector_grid, eval_grid = GF_fft_resolution(reflector_points, eval_points, normals, areas)
+    if resolution is None:
+        raise ValueError("GF_prop_fft needs regular, parallel xy grids with a shared normal and area, and an "
+                         "evaluation spacing that is an integer fraction of the reflector spacing.")
+    
+    (n, m), (p, q) = reflector_grid["shape"], eval_grid["shape"]
+    
+    # the kernel is H for a single reflector at the grid origin, sampled at every offset between the two grids
+    offsets_y = eval_grid["spacing"][1]*np.arange(-resolution*(n - 1), p)
+    offsets_x = eval_grid["spacing"][0]*np.arange(-resolution*(m - 1), q)
+    offsets_xx, offsets_yy = np.meshgrid(offsets_x, offsets_y)
+    kernel_points = np.stack((eval_grid["origin"][0] + offsets_xx.reshape(-1),
+                              eval_grid["origin"][1] + offsets_yy.reshape(-1),
+                              np.full(offsets_xx.size, eval_grid["origin"][2])), axis=1)
+    
+    normal = [np.asarray(normal).reshape(-1)[:1].reshape(1, 1) for normal in normals]
+    area = np.asarray(areas).reshape(-1)[:1].reshape(1, 1)
+    kernel = GF_propagator_function_builder(reflector_grid["origin"].reshape(1, 3), kernel_points, normal, area, k,
+                                            precision).reshape(offsets_xx.shape)
+    if prop_direction == "backward":
+        kernel = np.conj(kernel)
+    
+    # place the surface pressure onto the (finer) evaluation grid spacing
+    complex_pressure = np.asarray(complex_pressure, dtype=kernel.dtype)
+    batch_shape = complex_pressure.shape[:-1]
+    fine_pressure = np.zeros(batch_shape + (resolution*(n - 1) + 1, resolution*(m - 1) + 1), dtype=kernel.dtype)
+    fine_pressure[..., ::resolution, ::resolution] = complex_pressure.reshape(batch_shape + (n, m))
+    
+    kernel = kernel.reshape((1,)*len(batch_shape) + kernel.shape)
+    field = fftconvolve(fine_pressure, kernel, axes=(-2, -1))
+    field = field[..., resolution*(n - 1):resolution*(n - 1) + p, resolution*(m - 1):resolution*(m - 1) + q]
+    
+    return 2 * field.reshape(batch_shape + (p*q,)).astype(kernel.dtype, copy=False)
+
+
+def GF_fft_resolution(reflector_points, eval_points, normals, areas, rtol=1e-6):
+    
+    """
+    
+    checks whether "GF_prop_fft" can be used for a geometry.
+    
+    args:
+        reflector_points: matrix of x,y,z coords for the reflecting elements.
+        eval_points: matrix of evaluation x,y,z coords at the propagation plane.
+        normals: for a flat metasurface you get n*m times the vector [0, 0, 1].
+        areas: vector of the areas covered by each element (1, n*m).
+        rtol: (1e-6) relative tolerance used to compare spacings, normals and areas.
+        
+    returns:
+        resolution: ratio of the reflector spacing to the evaluation spacing, or None if the FFT cannot be used.
+        reflector_grid, eval_grid: grids found by "GF_regular_grid".
+    
+    """
+    
+    reflector_grid, eval_grid = GF_regular_grid(reflector_points, rtol), GF_regular_grid(eval_points, rtol)
+    if reflector_grid is None or eval_grid is None:
+        return None, reflector_grid, eval_grid
+    
+    # every element must share the same normal and area
+    normals = np.array([np.asarray(normal, dtype=float).reshape(-1) for normal in normals])
+    areas = np.asarray(areas, dtype=float).reshape(-1)
+    if not (np.allclose(normals, normals[:, :1], rtol=rtol, atol=0) and np.allclose(areas, areas[0], rtol=rtol, atol=0)):
+        return None, reflector_grid, eval_grid
+    
+    # the reflector grid must lie on the evaluation grid spacing, with the same ratio along x and y
+    ratios = np.array(reflector_grid["spacing"])/np.array(eval_grid["spacing"])
+    resolution = int(np.round(ratios[0]))
+    if resolution < 1 or not np.allclose(ratios, resolution, rtol=rtol, atol=0):
+        return None, reflector_grid, eval_grid
+    
+    return resolution, reflector_grid, eval_grid
+
+
+def GF_prop_auto(complex_pressure, reflector_points, eval_points, normals, areas, k, prop_direction, max_memory=2**28,
+                 precision=None):
+    
+    """
+    
+    propagates with "GF_prop_fft" when the geometry allows it, and with "GF_prop_tiled" otherwise.
+    
+    args:
+        as "GF_prop_tiled".
+        
+    returns:
+        complex pressure vector at the evaluation points (p*q), or (batch, p*q) for a stack of pressures.
+    
+    """
+    
+    if GF_fft_resolution(reflector_points, eval_points, normals, areas)[0] is not None:
+        return GF_prop_fft(complex_pressure, reflector_points, eval_points, normals, areas, k, prop_direction, precision)
+    
+    return GF_prop_tiled(complex_pressure, reflector_points, eval_points, normals, areas, k, prop_direction,
+                         max_memory, precision)
+
+
+def GF_compressed_propagator_builder(reflector_points, eval_points, normals, areas, k, tol=1e-6, method="aca",
+                                     block_length=None, max_rank=None, precision=None):
+    
+    """
+    
+    builds a compressed version of the propagator from "GF_propagator_function_builder". For evaluation planes many
+    wavelengths from the AMM, H is numerically low-rank, so memory and matvec cost scale with the rank instead of
+    n*m*p*q. The result can be passed to "GF_prop", "GFGS" and "GFGS_batch" in place of H.
+    
+    args:
+        reflector_points: matrix of x,y,z coords for the reflecting elements.
+        eval_points: matrix of evaluation x,y,z coords at the propagation plane.
+        normals: for a flat metasurface you get n*m times the vector [0, 0, 1].
+        areas: vector of the areas covered by each element (1, n*m).
+        k: wavenumber.
+        tol: (1e-6) relative accuracy of the compression.
+        method: "aca" (adaptive cross approximation, which only builds the pivot rows and columns of H) or "svd"
+        (randomized SVD of each dense block).
+        block_length: number of evaluation points per block, each compressed with its own rank. If None, H is
+        compressed as a single block.
+        max_rank: largest rank of any block.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        
+    returns:
+        H: LowRankPropagator, or a BlockPropagator if block_length is given.
+    
+    """
+    
+    from compression_functions import LowRankPropagator, BlockPropagator, aca_compress, randomized_svd_compress
+    
+    if method not in ("aca", "svd"):
+        raise ValueError(str(method) + " is not a valid compression method, please specify either 'aca' or 'svd'.")
+    
+    def compress_block(block_points):
+        
+        if method == "svd":
+            return randomized_svd_compress(GF_propagator_function_builder(reflector_points, block_points, normals,
+                                                                          areas, k, precision), tol, max_rank)
+        
+        # rows need the normal and area of a single reflector
+        get_row = lambda i: GF_propagator_function_builder(reflector_points[i:i + 1], block_points,
+                                                           [np.asarray(normal).reshape(-1)[i:i + 1] for normal in normals],
+                                                           np.asarray(areas).reshape(1, -1)[:, i:i + 1], k, precision)[0]
+        get_col = lambda j: GF_propagator_function_builder(reflector_points, block_points[j:j + 1], normals, areas, k,
+                                                           precision)[:, 0]
+        
+        return aca_compress(get_row, get_col, (len(reflector_points), len(block_points)), tol, max_rank,
+                            complex_dtype(precision))
+    
+    if block_length is None:
+        return compress_block(eval_points)
+    
+    blocks = []
+    for start in range(0, len(eval_points), block_length):
+        
+        block = compress_block(eval_points[start:start + block_length])
+        
+        # keep blocks which do not compress (e.g. close to the AMM) dense
+        if block.nbytes >= block.shape[0]*block.shape[1]*complex_dtype(precision).itemsize:
+            block = block.toarray()
+        blocks.append(block)
+        
+    return BlockPropagator(blocks)
+
+
+def GF_phase_loss(phases, H, incident_amplitude, abs_targets):
+    
+    """
+    
+    amplitude loss of a phase-only surface and its analytic gradient, using the forward propagator and its
+    conjugate. The loss of each target is 1 - (cosine similarity between |target plane pressure| and the target)**2,
+    which is 0 when the propagated amplitudes are proportional to the target and does not depend on their scale.
+    
+    args:
+        phases: (n*m, batch) surface phases.
+        H: the propagator function defined using "GF_propagator_function_builder", or a compressed propagator.
+        incident_amplitude: (n*m, 1) amplitude incident on the surface.
+        abs_targets: (p*q, batch) target amplitudes.
+        
+    returns:
+        loss: (batch) loss of each target.
+        gradient: (n*m, batch) derivative of the loss with respect to the phases.
+    
+    """
+    
+    spp = incident_amplitude*np.exp(1j*phases)
+    tpp = H.T @ spp
+    abs_tpp = abs(tpp)
+    
+    overlap = np.sum(abs_tpp*abs_targets, axis=0)
+    energy = np.maximum(np.sum(abs_tpp**2, axis=0), np.finfo(abs_tpp.dtype).tiny)
+    target_energy = np.sum(abs_targets**2, axis=0)
+    loss = 1 - overlap**2/(energy*target_energy)
+    
+    # derivative of the loss w.r.t. the conjugate target plane pressure, then back to the surface with conj(H)
+    unit_tpp = np.divide(tpp, abs_tpp, out=np.zeros_like(tpp), where=(abs_tpp != 0))
+    dloss_dtpp = -(2*overlap/(energy*target_energy))*abs_targets*unit_tpp + \
+                 (2*overlap**2/(energy**2*target_energy))*tpp
+    gradient = np.imag(np.conj(spp)*(H.conj() @ dloss_dtpp))
+    
+    return loss, gradient
+
+
+def GF_phase_retrieval(H, incident_surface_pressure, abs_targets, iterations=100, method="lbfgs", learning_rate=0.1,
+                       tol=1e-6, verbose=False):
+    
+    """
+    
+    phase-only hologram optimisation by gradient descent on the amplitude loss of "GF_phase_loss", as an alternative
+    to GFGS which converges faster on multi-focus and image targets. A stack of targets is optimised at once.
+    
+    args:
+        H: the propagator function defined using "GF_propagator_function_builder", or a compressed propagator.
+        incident_surface_pressure: complex pressure incident on the surface (n*m).
+        abs_targets: (batch, p*q) stack of target amplitudes, or a single (p*q) target.
+        iterations: (100) maximum number of iterations.
+        method: "lbfgs" (scipy's L-BFGS-B) or "adam".
+        learning_rate: (0.1 [rad]) step size for "adam".
+        tol: (1e-6) relative change in the total loss at which the optimisation stops.
+        verbose: if True, print the loss at each iteration.
+        
+    returns:
+        spp: (batch, n*m) complex surface pressures.
+        history: dictionary with the (iterations, batch) "loss", and the number of "propagations" (forward plus
+        backward) that were used.
+    
+    """
+    
+    if method not in ("lbfgs", "adam"):
+        raise ValueError(str(method) + " is not a valid method, please specify either 'lbfgs' or 'adam'.")
+    
+    real = np.finfo(H.dtype).dtype
+    abs_targets = np.atleast_2d(abs_targets).reshape(-1, H.shape[1]).T.astype(real)
+    incident_amplitude = abs(incident_surface_pressure).reshape(-1, 1).astype(real)
+    
+    # start from the first GS backpropagation of the target
+    phases = np.angle(H.conj() @ (abs_targets*np.exp(1j*np.pi*abs_targets))).astype(real)
+    loss_history, propagations = [], 1
+    
+    if method == "adam":
+        
+        beta1, beta2, eps = 0.9, 0.999, 1e-8
+        m, v = np.zeros_like(phases), np.zeros_like(phases)
+        
+        for it in range(iterations):
+            
+            loss, gradient = GF_phase_loss(phases, H, incident_amplitude, abs_targets)
+            loss_history.append(loss)
+            propagations += 2
+            
+            if verbose:
+                print("Iteration:", str(it), "... loss:", str(np.sum(loss)))
+            
+            if it > 0 and abs(np.sum(loss_history[-2]) - np.sum(loss)) <= tol*np.sum(loss_history[-2]):
+                break
+            
+            m = beta1*m + (1 - beta1)*gradient
+            v = beta2*v + (1 - beta2)*gradient**2
+            phases = phases - learning_rate*(m/(1 - beta1**(it + 1)))/(np.sqrt(v/(1 - beta2**(it + 1))) + eps)
+            
+    else:
+        
+        from scipy.optimize import minimize
+        
+        last_loss = None
+        
+        def total_loss(flat_phases):
+            
+            nonlocal propagations, last_loss
+            propagations += 2
+            last_loss, gradient = GF_phase_loss(flat_phases.reshape(phases.shape), H, incident_amplitude, abs_targets)
+            
+            return np.sum(last_loss, dtype=float), gradient.ravel().astype(float)
+        
+        def record(flat_phases):
+            
+            # the line search ends on the accepted point, so the last evaluated loss belongs to this iteration
+            loss_history.append(last_loss)
+            if verbose:
+                print("Iteration:", str(len(loss_history) - 1), "... loss:", str(np.sum(loss_history[-1])))
+        
+        result = minimize(total_loss, phases.ravel().astype(float), jac=True, method="L-BFGS-B", callback=record,
+                          options={"maxiter": iterations, "ftol": tol, "gtol": 0})
+        phases = result.x.reshape(phases.shape).astype(real)
+        
+    spp = incident_surface_pressure.reshape(-1, 1).astype(H.dtype)*np.exp(1j*phases)
+    history = {"loss": np.array(loss_history), "propagations": propagations}
+    
+    return spp.T, history
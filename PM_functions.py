@@ -1,12 +1,14 @@
 import os
 import sys
 import time
+import functools
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import itertools as it
 import math as math
 from scipy.special import comb
+from functions import chunked_dot, real_dtype, complex_dtype, get_precision
 
 
 def vmag3D(vector):
@@ -86,7 +88,122 @@ def find_sin_theta(tp_vec, tran_normal):
     return sin_theta
     
     
-def PM_propagator_function_builder(tp_vec, sin_theta, k, p0=8.02, d=10/1000):
+@functools.lru_cache(maxsize=16)
+def PM_directivity_table_builder(k, d, samples, precision):
+    
+    """ 
+    
+    tabulates the exact piston directivity for "PM_directivity_table". Results are kept in a small LRU cache
+    (PM_directivity_table_builder.cache_clear() empties it), so use "PM_directivity_table" which normalises its
+    arguments before looking them up.
+    
+    args:
+        k: wavenumber.
+        d: diameter of transducer [m].
+        samples: number of entries in the table.
+        precision: "single" or "double".
+        
+    returns:
+        table: read-only directivity (samples), 1/2 on axis.
+        
+    """
+    
+    from scipy.special import j1
+    
+    J_arg = k*(d/2)*np.linspace(0, 1, samples)
+    
+    table = np.full(samples, 0.5) # limit of J_1(x)/x at x = 0
+    table[1:] = j1(J_arg[1:])/J_arg[1:]
+    
+    table = table.astype(real_dtype(precision))
+    table.flags.writeable = False
+    
+    return table
+    
+    
+def PM_directivity_table(k, d=10/1000, samples=4096, precision=None):
+    
+    """ 
+    
+    returns the (cached) exact piston directivity, J_1(x)/x with x = k*(d/2)*sin_theta, at samples evenly spaced
+    values of sin_theta between 0 and 1, for use with "PM_directivity".
+    
+    args:
+        k: wavenumber.
+        d: (10/1000 [m]) diameter of transducer.
+        samples: (4096) number of entries in the table.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        
+    returns:
+        table: read-only directivity (samples), 1/2 on axis.
+        
+    """
+    
+    return PM_directivity_table_builder(float(k), float(d), int(samples), get_precision(precision))
+    
+    
+def PM_measured_directivity(angles, amplitudes, samples=4096, precision=None):
+    
+    """ 
+    
+    builds a directivity table, for use with "PM_directivity", from a measured directivity, so that other
+    transducers can be modelled. The measurement is normalised to its on-axis value and scaled to the on-axis value
+    of J_1(x)/x (1/2), so that p0 keeps its meaning.
+    
+    args:
+        angles: angles from the transducer normal at which the directivity was measured [rad], including 0.
+        amplitudes: measured pressure amplitude at each angle.
+        samples: (4096) number of entries in the table.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        
+    returns:
+        table: directivity at samples evenly spaced values of sin_theta between 0 and 1.
+        
+    """
+    
+    order = np.argsort(angles)
+    sin_angles, amplitudes = np.sin(np.asarray(angles, dtype=float)[order]), np.asarray(amplitudes, dtype=float)[order]
+    
+    if not np.all(np.diff(sin_angles) > 0):
+        raise ValueError("the angles must be distinct and between 0 and pi/2.")
+    
+    table = np.interp(np.linspace(0, 1, samples), sin_angles, amplitudes)
+    
+    return (0.5*table/np.interp(0, sin_angles, amplitudes)).astype(real_dtype(precision))
+    
+    
+def PM_directivity(sin_theta, table):
+    
+    """ 
+    
+    evaluates a directivity table (from "PM_directivity_table" or "PM_measured_directivity") by linear
+    interpolation.
+    
+    args:
+        sin_theta: sin of angle between tran normal and the vector drawn between the transducer and each point.
+        table: directivity at evenly spaced values of sin_theta between 0 and 1.
+        
+    returns:
+        directivity at each sin_theta, in the dtype of the table.
+        
+    """
+    
+    real = table.dtype.type
+    slopes = np.diff(table)
+    
+    # position in the table, split into the entry below and the fraction of the way to the next one
+    position = np.clip(np.asarray(sin_theta, dtype=real), 0, 1)
+    position *= real(len(table) - 1)
+    index = np.minimum(position.astype(np.intp), len(table) - 2)
+    position -= index
+    
+    position *= slopes[index]
+    position += table[index]
+    
+    return position
+    
+    
+def PM_propagator_function_builder(tp_vec, sin_theta, k, p0=8.02, d=10/1000, precision=None, directivity="taylor"):
     
     """ 
     Piston model calculator. Finds the complex pressure propagated by transducers from
@@ -98,24 +215,70 @@ def PM_propagator_function_builder(tp_vec, sin_theta, k, p0=8.02, d=10/1000):
         k = wavenumber
         p0 = (8.02 [Pa]) reference pressure for Murata transducer measured at a distance of 1m
         d = (10/1000 [m]) diameter of transducer.
+        precision = "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        directivity = ("taylor") how the directivity J_1(x)/x is found: "taylor" for its 10th order Taylor series
+        (which diverges for large k*d*sin_theta), "exact" for a table of the Bessel function (see
+        "PM_directivity_table"), or a table of another transducer from "PM_measured_directivity".
         
     returns:
         
         
     """
-    # argument of 1st order Bessel function
-    J_arg = k*(d/2)*sin_theta
+    real = real_dtype(precision)
+    tp_vec, sin_theta = np.asarray(tp_vec, dtype=real), np.asarray(sin_theta, dtype=real)
+    
+    if isinstance(directivity, str) and directivity not in ("taylor", "exact"):
+        raise ValueError(str(directivity) + " is not a valid directivity, please specify 'taylor', 'exact' or a table.")
     
-    # taylor expansion of first order Bessel function over its agrument (J_1(J_arg)/J_arg)
-    tay = (1/2)-(J_arg**2/16)+(J_arg**4/384)-(J_arg**6/18432)+(J_arg**8/1474560)-(J_arg**10/176947200)
+    if isinstance(directivity, str) and directivity == "taylor":
+        
+        k, p0, d = real.type(k), real.type(p0), real.type(d)
+        
+        # argument of 1st order Bessel function
+        J_arg = k*(d/2)*sin_theta
+        
+        # taylor expansion of first order Bessel function over its agrument (J_1(J_arg)/J_arg)
+        tay = (1/2)-(J_arg**2/16)+(J_arg**4/384)-(J_arg**6/18432)+(J_arg**8/1474560)-(J_arg**10/176947200)
+        
+    else:
+        
+        if isinstance(directivity, str):
+            directivity = PM_directivity_table(k, d, precision=precision)
+        
+        tay = PM_directivity(sin_theta, np.asarray(directivity, dtype=real))
+        k, p0 = real.type(k), real.type(p0)
     
     # propagator function
     H = 2*p0*(tay/tp_vec)*np.exp(1j*k*tp_vec)
     
-    return H
+    return H.astype(complex_dtype(precision), copy=False)
+    
+    
+def PM_propagator(target_points, tran_points, tran_plane_normal_vector, k, precision=None, directivity="taylor"):
+
+    """ 
     
+    builds the piston model propagator between each transducer and each evaluation point.
     
-def PM_prop(target_points, tran_points, tran_plane_normal_vector, k, A_magnitude = 1):
+    args:
+        target_points: array describing the evaluation points where we want to find complex pressure.
+        tran_points: array describing the centrepoint of each transducer.
+        tran_plane_normal_vector = normal vector describing the direction in which transducers are pointing.
+        k: wavenumber.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        directivity: ("taylor") "taylor", "exact" or a measured table, see "PM_propagator_function_builder".
+    
+    returns:
+        H: (transducers, points) array of complex propagator values.
+        
+    """
+    
+    # built by broadcasting rather than with "find_tp_vec" and "find_sin_theta", which loop over every pair
+    return PM_propagator_vectorised(target_points, tran_points, tran_plane_normal_vector, k, precision=precision,
+                                    directivity=directivity)
+    
+    
+def PM_prop(target_points, tran_points, tran_plane_normal_vector, k, A_magnitude = 1, precision=None):
 
     """ 
     
@@ -127,6 +290,7 @@ def PM_prop(target_points, tran_points, tran_plane_normal_vector, k, A_magnitude
         tran_plane_normal_vector = normal vector describing the direction in which transducers are pointing.
         k: wavenumber.
         A_magnitude: 1 denotes transducers driven at maximum amplitude. 0 denotes transducers switched off.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
     
     returns:
         Pf: array of complex pressure values at the evaluation points.
@@ -134,19 +298,309 @@ def PM_prop(target_points, tran_points, tran_plane_normal_vector, k, A_magnitude
     """
     
     # ----> propagation to target plane <----
-    tp_vec = find_tp_vec(target_points, tran_points)
-    tp_mag = np.array([np.linalg.norm(tp_coord) for tp_coord in tp_vec])
-    sin_theta_array = find_sin_theta(tp_vec, tran_plane_normal_vector)
-
-    H = PM_propagator_function_builder(tp_mag, sin_theta_array, k) # propagator
-    H = H.reshape(len(tran_points), len(target_points)) # reshape from vector to array
+    H = PM_propagator(target_points, tran_points, tran_plane_normal_vector, k, precision)
 
     Pt = A_magnitude*np.ones(len(tran_points))*np.exp(1j*np.zeros(len(tran_points))) # transducer complex pressure
+    Pt = Pt.astype(H.dtype, copy=False) # kept in the precision of the propagator
     Pf = np.dot(Pt, H)
     
     return Pf
     
     
+def PM_propagator_vectorised(target_points, tran_points, tran_plane_normal_vector, k, p0=8.02, d=10/1000,
+                             max_memory=2**28, workers=None, precision=None, directivity="taylor"):
+
+    """ 
+    
+    broadcast version of "PM_propagator", which builds the (transducers, points) propagator directly instead of
+    looping over every transducer/point pair in Python. The points are split into chunks within a memory budget,
+    and the chunks can be shared across a thread pool (NumPy releases the GIL inside its ufuncs).
+    
+    args:
+        target_points: (points, 3) array of the evaluation points where we want to find complex pressure.
+        tran_points: (transducers, 3) array of the centrepoint of each transducer.
+        tran_plane_normal_vector: normal vector describing the direction in which transducers are pointing.
+        k: wavenumber.
+        p0: (8.02 [Pa]) reference pressure for Murata transducer measured at a distance of 1m.
+        d: (10/1000 [m]) diameter of transducer.
+        max_memory: (2**28 [bytes]) memory budget for the temporaries of each chunk.
+        workers: number of threads, defaults to the number of cores.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        directivity: ("taylor") "taylor", "exact" or a measured table, see "PM_propagator_function_builder".
+    
+    returns:
+        H: (transducers, points) array of complex propagator values.
+        
+    """
+    
+    import concurrent.futures
+    
+    target_points = np.asarray(target_points, dtype=float).reshape(-1, 3)
+    tran_points = np.asarray(tran_points, dtype=float).reshape(-1, 3)
+    nx, ny, nz = np.asarray(tran_plane_normal_vector, dtype=float).reshape(3)
+    normal_mag = np.sqrt(nx**2 + ny**2 + nz**2)
+    
+    H = np.empty((len(tran_points), len(target_points)), dtype=complex_dtype(precision))
+    
+    # about 16 float64 temporaries per transducer/point pair
+    chunk_length = max(1, int(max_memory / (128*len(tran_points))))
+    chunks = [slice(start, start + chunk_length) for start in range(0, len(target_points), chunk_length)]
+    
+    def build_chunk(cols):
+        
+        # vectors from each transducer to each point of the chunk, one axis at a time
+        dx, dy, dz = [target_points[None, cols, axis] - tran_points[:, axis, None] for axis in range(3)]
+        tp_mag = np.sqrt(dx**2 + dy**2 + dz**2)
+        
+        # sin of the angle to the normal, |tp x n|/(|tp||n|), as in "find_sin_theta"
+        cross_mag = np.sqrt((dy*nz - dz*ny)**2 + (dz*nx - dx*nz)**2 + (dx*ny - dy*nx)**2)
+        sin_theta = cross_mag / (tp_mag*normal_mag)
+        
+        H[:, cols] = PM_propagator_function_builder(tp_mag, sin_theta, k, p0, d, precision, directivity)
+        
+    workers = os.cpu_count() if workers is None else workers
+    
+    if workers > 1 and len(chunks) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(build_chunk, chunks))
+    else:
+        for cols in chunks:
+            build_chunk(cols)
+    
+    return H
+    
+    
+def PM_prop_batch(tran_pressures, H, max_memory=2**28):
+
+    """ 
+    
+    Propagates a stack of transducer complex pressures through a piston model propagator at once, using chunked
+    matrix-matrix products instead of one matrix-vector product per pattern.
+    
+    args:
+        tran_pressures: (batch, transducers) array of complex transducer pressures.
+        H: (transducers, points) propagator built with "PM_propagator".
+        max_memory: (2**28 [bytes]) memory budget for the output of each chunk.
+    
+    returns:
+        Pf: (batch, points) array of complex pressure values at the evaluation points.
+        
+    """
+    
+    return chunked_dot(tran_pressures, H, max_memory)
+    
+    
+def PM_GSPAT(H, target_amplitudes=None, iterations=10, point_phases=None, weights=None):
+
+    """ 
+    
+    GS-PAT multi-focus solver (Plasencia et al. 2020). Only the propagator from every transducer to the focal points
+    is needed, so each iteration costs two small (transducers, points) products: the point pressures are taken back
+    to the transducers through B, the normalised conjugate of the propagator, the phase-only transducer constraint is
+    applied and the result is propagated forward to the points. The point pressures are scaled by weights that
+    equalise the amplitudes the phase-only board actually produces, so the weights of a previous solution are a
+    meaningful warm start.
+    
+    args:
+        H: (transducers, points) propagator to the focal points (e.g. from "PM_propagator"), or a stack of them
+        shaped (batch, transducers, points).
+        target_amplitudes: relative amplitude wanted at each point, (points) or (batch, points), defaults to equal
+        amplitudes. Points with a zero target are not driven (their pressure is not actively cancelled).
+        iterations: (10) number of iterations.
+        point_phases: initial phase of each point, (points) or (batch, points), defaults to 0. Passing the
+        point_phases of a previous, similar solution warm-starts the solver.
+        weights: amplitude-equalising weight of each point, (points) or (batch, points), defaults to 1. Passed
+        together with point_phases from a previous solution to complete the warm start.
+        
+    returns:
+        tran_phases: (batch, transducers) or (transducers) phase of each transducer.
+        point_phases: (batch, points) or (points) phase of each point, for warm-starting the next solve.
+        weights: (batch, points) or (points) weight of each point, for warm-starting the next solve.
+        
+    """
+    
+    single = H.ndim == 2
+    H = H[np.newaxis] if single else H
+    batch, _, points = H.shape
+    real = np.finfo(H.dtype).dtype
+    
+    target_amplitudes = np.ones((batch, points), dtype=real) if target_amplitudes is None else \
+        np.broadcast_to(np.asarray(target_amplitudes, dtype=real), (batch, points))
+    point_phases = np.zeros((batch, points), dtype=real) if point_phases is None else \
+        np.broadcast_to(np.asarray(point_phases, dtype=real), (batch, points))
+    
+    # backward propagator, normalised by the power reaching each point
+    B = np.conj(H) / np.sum(abs(H)**2, axis=1, keepdims=True)
+    F = np.swapaxes(H, 1, 2) # (batch, points, transducers)
+    
+    weights = np.ones((batch, points), dtype=real) if weights is None else \
+        np.array(np.broadcast_to(np.asarray(weights, dtype=real), (batch, points)))
+    p = target_amplitudes*weights*np.exp(1j*point_phases)
+    
+    active = target_amplitudes > 0
+    
+    for it in range(iterations):
+        
+        tran_phases = np.angle(np.matmul(B, p[..., np.newaxis])[..., 0])
+        p = np.matmul(F, np.exp(1j*tran_phases)[..., np.newaxis])[..., 0]
+        amplitudes = abs(p)
+        
+        # raise the weight of points below their target amplitude and lower those above it. Points with a zero
+        # target are not driven and are left out of the equalisation
+        ratios = np.divide(amplitudes, target_amplitudes, out=np.zeros_like(amplitudes), where=active)
+        mean_ratios = np.sum(ratios, axis=1, keepdims=True) / np.maximum(np.sum(active, axis=1, keepdims=True), 1)
+        weights *= np.divide(mean_ratios, ratios, out=np.ones_like(ratios), where=ratios > 0)
+        p = target_amplitudes*weights*np.divide(p, amplitudes, out=np.zeros_like(p), where=amplitudes > 0)
+        
+    tran_phases = np.angle(np.matmul(B, p[..., np.newaxis])[..., 0])
+    point_phases = np.angle(p)
+    
+    return (tran_phases[0], point_phases[0], weights[0]) if single else (tran_phases, point_phases, weights)
+    
+    
+def PM_GSPAT_stream(point_sets, tran_points, tran_plane_normal_vector, k, batch_length=32, iterations=10,
+                    target_amplitudes=None, precision=None, directivity="taylor", stats=None, verbose=False):
+
+    """ 
+    
+    solves a stream of focal point sets with "PM_GSPAT", in batches. The propagators of a whole batch are built in
+    one call to "PM_propagator_vectorised" and solved together, so the Python overhead is paid once per batch.
+    
+    args:
+        point_sets: iterable of (points, 3) arrays of focal points. Consecutive sets with the same number of points
+        are batched together.
+        tran_points: (transducers, 3) array of the centrepoint of each transducer.
+        tran_plane_normal_vector: normal vector describing the direction in which transducers are pointing.
+        k: wavenumber.
+        batch_length: (32) largest number of point sets solved together.
+        iterations: (10) number of GS-PAT iterations.
+        target_amplitudes: relative amplitude wanted at each point, defaults to equal amplitudes.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        directivity: ("taylor") "taylor", "exact" or a measured table, see "PM_propagator_function_builder".
+        stats: optional dictionary which is kept updated with the number of "solutions", the "time" spent solving
+        [s] and the "solutions_per_second".
+        verbose: if True, print the throughput after every batch.
+        
+    yields:
+        tran_phases: (transducers) phase of each transducer, for each point set in turn.
+        
+    """
+    
+    stats = {} if stats is None else stats
+    stats.update(solutions=0, time=0.0, solutions_per_second=0.0)
+    tran_points = np.asarray(tran_points, dtype=float).reshape(-1, 3)
+    
+    def solve(batch):
+        
+        start = time.perf_counter()
+        
+        # one propagator for every point of the batch, split into a (batch, transducers, points) stack
+        points = np.concatenate(batch)
+        H = PM_propagator_vectorised(points, tran_points, tran_plane_normal_vector, k, workers=1, precision=precision,
+                                     directivity=directivity)
+        H = np.swapaxes(H.reshape(len(tran_points), len(batch), -1), 0, 1)
+        tran_phases, _, _ = PM_GSPAT(H, target_amplitudes, iterations)
+        
+        stats["solutions"] += len(batch)
+        stats["time"] += time.perf_counter() - start
+        stats["solutions_per_second"] = stats["solutions"] / stats["time"]
+        
+        if verbose:
+            print("solved", stats["solutions"], "point sets,", round(stats["solutions_per_second"]), "solutions/s")
+        
+        return tran_phases
+    
+    batch = []
+    
+    for point_set in point_sets:
+        
+        point_set = np.asarray(point_set, dtype=float).reshape(-1, 3)
+        
+        if batch and (len(batch) == batch_length or len(point_set) != len(batch[0])):
+            yield from solve(batch)
+            batch = []
+            
+        batch.append(point_set)
+        
+    if batch:
+        yield from solve(batch)
+    
+    
+def PM_GSPAT_trajectory(frames, tran_points, tran_plane_normal_vector, k, iterations=2, initial_iterations=10,
+                        target_amplitudes=None, precision=None, directivity="taylor", stats=None):
+
+    """ 
+    
+    solves a stream of frames of moving focal points (e.g. levitation traps along a trajectory) with "PM_GSPAT".
+    Consecutive frames are nearly identical, so each frame is warm-started from the point phases and weights of the
+    previous one and only needs a couple of iterations, and only the propagator columns of points which moved are rebuilt.
+    The first frame (and any frame where the number of points changes) is seeded with the superposition of the
+    single-focus phasemaps from functions.focus_phasemap_builder and solved with initial_iterations.
+    
+    args:
+        frames: iterable of (points, 3) arrays of focal points, one per frame.
+        tran_points: (transducers, 3) array of the centrepoint of each transducer.
+        tran_plane_normal_vector: normal vector describing the direction in which transducers are pointing.
+        k: wavenumber.
+        iterations: (2) number of GS-PAT iterations for each warm-started frame.
+        initial_iterations: (10) number of GS-PAT iterations for a frame solved from scratch.
+        target_amplitudes: relative amplitude wanted at each point, defaults to equal amplitudes.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        directivity: ("taylor") "taylor", "exact" or a measured table, see "PM_propagator_function_builder".
+        stats: optional dictionary which is kept updated with the number of "frames", the number of propagator
+        "columns_updated", the "time" spent solving [s] and the "frames_per_second".
+        
+    yields:
+        tran_phases: (transducers) phase of each transducer, for each frame in turn.
+        
+    """
+    
+    from functions import focus_phasemap_builder
+    
+    stats = {} if stats is None else stats
+    stats.update(frames=0, columns_updated=0, time=0.0, frames_per_second=0.0)
+    tran_points = np.asarray(tran_points, dtype=float).reshape(-1, 3)
+    previous_points, H, point_phases, weights = None, None, None, None
+    
+    for points in frames:
+        
+        start = time.perf_counter()
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        
+        if previous_points is None or len(points) != len(previous_points):
+            
+            H = PM_propagator_vectorised(points, tran_points, tran_plane_normal_vector, k, workers=1,
+                                         precision=precision, directivity=directivity)
+            
+            # seed with the sum of the single-focus phasemaps (which take the negated focal point)
+            tran_field = np.sum([np.exp(1j*focus_phasemap_builder(tran_points, -point, k)) for point in points], axis=0)
+            point_phases, weights = np.angle(tran_field @ H), None
+            
+            frame_iterations, updated = initial_iterations, len(points)
+            
+        else:
+            
+            # rebuild only the columns of the points which moved
+            moved = np.flatnonzero(np.any(points != previous_points, axis=1))
+            if len(moved):
+                H[:, moved] = PM_propagator_vectorised(points[moved], tran_points, tran_plane_normal_vector, k,
+                                                       workers=1, precision=precision, directivity=directivity)
+                
+            frame_iterations, updated = iterations, len(moved)
+            
+        tran_phases, point_phases, weights = PM_GSPAT(H, target_amplitudes, frame_iterations, point_phases, weights)
+        
+        # copied, so that frames updated in place by the caller are still seen to have moved
+        previous_points = points.copy()
+        
+        stats["frames"] += 1
+        stats["columns_updated"] += updated
+        stats["time"] += time.perf_counter() - start
+        stats["frames_per_second"] = stats["frames"] / stats["time"]
+        
+        yield tran_phases
+    
+    
 def hexagon_diameter_to_coordinates(d, x_spacing=10.5/1000, y_spacing=9/1000) -> list((float, float, float)):
     
     """
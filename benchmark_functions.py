@@ -0,0 +1,410 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+
+
+def benchmark(function, *args, repeats=3, **kwargs):
+
+    """
+
+    times a function and measures the peak memory it allocates.
+
+    args:
+        function: function to benchmark.
+        args, kwargs: its arguments.
+        repeats: (3) number of timed runs, the fastest of which is reported.
+
+    returns:
+        result: output of the function.
+        record: dict with the wall "time" [s] and "peak_memory" [bytes], the memory being traced (with tracemalloc)
+        over one extra, untimed run so that tracing does not slow down the timed runs.
+
+    """
+
+    times = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(*args, **kwargs)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, {"time": min(times), "peak_memory": peak_memory}
+
+
+def relative_error(result, reference):
+
+    """ relative L2 error of a result against a reference. """
+
+    result, reference = np.asarray(result).ravel(), np.asarray(reference).ravel()
+
+    return float(np.linalg.norm(result - reference) / np.linalg.norm(reference))
+
+
+def pattern_error(field, target):
+
+    """ 1 - the normalised correlation of the amplitude of a field with a target pattern (0 is a perfect match). """
+
+    field, target = abs(np.asarray(field)).ravel(), np.asarray(target, dtype=float).ravel()
+
+    return float(1 - np.sum(field*target) / np.sqrt(np.sum(field**2)*np.sum(target**2)))
+
+
+def benchmark_geometry(size, resolution, target_dist, k):
+
+    """
+
+    builds the geometry shared by the benchmarks: a square AMM of size x size cells at half-wavelength spacing and a
+    parallel evaluation plane with resolution points per cell, laid out like the output of "ASM_prop".
+
+    args:
+        size: number of cells along each side of the AMM.
+        resolution: number of evaluation points per cell along each side.
+        target_dist: distance to the evaluation plane [m].
+        k: wavenumber.
+
+    returns:
+        geometry: dict of "cell_spacing", "reflector_points", "eval_points", "normals" and "areas".
+
+    """
+
+    cell_spacing = np.pi/k
+
+    # cell and evaluation point centres, x varying fastest as in functions.points_vector_builder
+    x = (np.arange(size) - (size - 1)/2)*cell_spacing
+    xx, yy = np.meshgrid(x, x)
+    reflector_points = np.stack((xx.ravel(), yy.ravel(), np.zeros(xx.size)), axis=1)
+
+    x = (np.arange(size*resolution) - (size*resolution - 1)/2)*cell_spacing/resolution
+    xx, yy = np.meshgrid(x, x)
+    eval_points = np.stack((xx.ravel(), yy.ravel(), target_dist*np.ones(xx.size)), axis=1)
+
+    normals = [np.zeros((1, size**2)), np.zeros((1, size**2)), np.ones((1, size**2))]
+    areas = cell_spacing**2*np.ones((1, size**2))
+
+    return {"cell_spacing": cell_spacing, "reflector_points": reflector_points, "eval_points": eval_points,
+            "normals": normals, "areas": areas}
+
+
+def benchmark_targets(size, pattern_count, seed=0):
+
+    """ random binary target patterns (size x size), one per pattern. """
+
+    rng = np.random.default_rng(seed)
+
+    # blocky patterns, so that they are reachable at half-wavelength sampling
+    blocks = rng.random((pattern_count, max(1, size // 4), max(1, size // 4))) > 0.5
+    blocks[:, 0, 0] = True # no empty patterns
+    targets = np.kron(blocks, np.ones((4, 4)))[:, :size, :size]
+
+    return np.pad(targets, ((0, 0), (0, size - targets.shape[1]), (0, size - targets.shape[2]))).astype(float)
+
+
+def benchmark_propagation(size, resolution, precision, k, target_dist=0.05, repeats=3):
+
+    """
+
+    benchmarks forward propagation of an AMM phasemap focusing at the centre of the evaluation plane with "ASM_prop"
+    and with "GF_prop" (including building H with "GF_propagator_function_builder"). The reference is the double
+    precision GF field. The surface given to "ASM_prop" is zero-padded by "ASM_padding" against wrap-around and its
+    field cropped back to the evaluation plane, both inside the timed run.
+
+    returns:
+        records: list of result dicts, one per engine.
+
+    """
+
+    from ASM_functions import ASM_prop, ASM_padding
+    from GF_functions import GF_propagator_function_builder, GF_prop
+
+    geometry = benchmark_geometry(size, resolution, target_dist, k)
+    focal_dists = np.linalg.norm(geometry["reflector_points"] - [0, 0, target_dist], axis=1)
+    surface_pressure = np.exp(-1j*k*focal_dists).reshape(size, size)
+
+    def GF_run(precision):
+        H = GF_propagator_function_builder(geometry["reflector_points"], geometry["eval_points"], geometry["normals"],
+                                           geometry["areas"], k, precision)
+        return GF_prop(surface_pressure.reshape(1, -1), H, "forward").reshape(size*resolution, size*resolution)
+
+    reference = GF_run("double")
+
+    records = []
+
+    field, record = benchmark(GF_run, precision, repeats=repeats)
+    records.append(dict(record, engine="GF_prop", error=relative_error(field, reference)))
+
+    def ASM_run(precision):
+        pw = ASM_padding(surface_pressure.shape, geometry["cell_spacing"], target_dist, k)
+        field = ASM_prop(np.pad(surface_pressure, pw), geometry["cell_spacing"], target_dist, resolution, k, precision)
+        return field[pw[0][0]*resolution:(pw[0][0] + size)*resolution, pw[1][0]*resolution:(pw[1][0] + size)*resolution]
+
+    field, record = benchmark(ASM_run, precision, repeats=repeats)
+    records.append(dict(record, engine="ASM_prop", error=relative_error(field, reference)))
+
+    return records
+
+
+def benchmark_PM(size, resolution, precision, k, target_dist=0.1, repeats=3):
+
+    """
+
+    benchmarks "PM_prop" for a size x size array of transducers (10.5mm pitch) propagating to a plane with
+    resolution points per transducer along each side. The reference is the double precision result.
+
+    returns:
+        records: list with one result dict.
+
+    """
+
+    from PM_functions import PM_prop
+
+    pitch = 10.5/1000
+    x = (np.arange(size) - (size - 1)/2)*pitch
+    xx, yy = np.meshgrid(x, x)
+    tran_points = np.stack((xx.ravel(), yy.ravel(), np.zeros(xx.size)), axis=1)
+
+    x = (np.arange(size*resolution) - (size*resolution - 1)/2)*pitch/resolution
+    xx, yy = np.meshgrid(x, x)
+    target_points = np.stack((xx.ravel(), yy.ravel(), target_dist*np.ones(xx.size)), axis=1)
+
+    normal = np.array([0, 0, 1])
+
+    reference = PM_prop(target_points, tran_points, normal, k, precision="double")
+    field, record = benchmark(PM_prop, target_points, tran_points, normal, k, precision=precision, repeats=repeats)
+
+    return [dict(record, engine="PM_prop", error=relative_error(field, reference))]
+
+
+def benchmark_GS(size, pattern_count, precision, k, target_dist=0.05, iterations=50, repeats=1):
+
+    """
+
+    benchmarks designing pattern_count phasemaps with "GFGS" (on a prebuilt H) and "ASM_Iterative_GS". The error
+    is the "pattern_error" of each design propagated with the double precision GF propagator, averaged over the
+    patterns.
+
+    returns:
+        records: list of result dicts, one per engine.
+
+    """
+
+    from ASM_functions import ASM_Iterative_GS
+    from GF_functions import GF_propagator_function_builder, GF_prop, GFGS
+
+    geometry = benchmark_geometry(size, 1, target_dist, k)
+    targets = benchmark_targets(size, pattern_count)
+    incident_surface_pressure = np.ones((size, size), dtype=complex)
+    H_reference = GF_propagator_function_builder(geometry["reflector_points"], geometry["eval_points"],
+                                                 geometry["normals"], geometry["areas"], k, "double")
+    H = H_reference if precision == "double" else \
+        GF_propagator_function_builder(geometry["reflector_points"], geometry["eval_points"], geometry["normals"],
+                                       geometry["areas"], k, precision)
+
+    def error(phasemaps):
+        fields = GF_prop(np.reshape(phasemaps, (pattern_count, -1)), H_reference, "forward")
+        return float(np.mean([pattern_error(field, target) for field, target in zip(fields, targets)]))
+
+    records = []
+
+    def GF_run():
+        return [GFGS(H, incident_surface_pressure.ravel(), target.reshape(-1, 1), iterations) for target in targets]
+
+    phasemaps, record = benchmark(GF_run, repeats=repeats)
+    records.append(dict(record, engine="GFGS", error=error(phasemaps)))
+
+    def ASM_run():
+        return [ASM_Iterative_GS(target, incident_surface_pressure, iterations, geometry["cell_spacing"], target_dist,
+                                 k, precision) for target in targets]
+
+    phasemaps, record = benchmark(ASM_run, repeats=repeats)
+    records.append(dict(record, engine="ASM_Iterative_GS", error=error(phasemaps)))
+
+    return records
+
+
+def benchmark_AHC(size, pattern_count, repeats=1):
+
+    """
+
+    benchmarks "run_AHC_algorithm" (contiguous clustering, nothing saved) on pattern_count random size x size
+    phasemaps. Clustering has no reference result, so the error is None.
+
+    returns:
+        records: list with one result dict.
+
+    """
+
+    from AHC_functions import run_AHC_algorithm
+
+    inputs = list(2*np.pi*np.random.default_rng(0).random((pattern_count, size, size)))
+
+    with tempfile.TemporaryDirectory() as folder:
+        _, record = benchmark(run_AHC_algorithm, inputs, "contiguous_clustering_adjacent", folder, False, True, False,
+                              repeats=repeats)
+
+    return [dict(record, engine="run_AHC_algorithm", error=None)]
+
+
+def run_benchmarks(sizes=(16, 32), resolutions=(1, 2), pattern_counts=(1, 4), precisions=("double", "single"),
+                   workloads=("propagation", "PM", "GS", "AHC"), k=2*np.pi*40000/343, repeats=3, ahc_max_size=6,
+                   output_file=None, verbose=True):
+
+    """
+
+    sweeps the benchmarks over AMM size, evaluation resolution, pattern count and precision.
+
+    args:
+        sizes: ((16, 32)) AMM sizes (cells, or transducers for "PM", along each side).
+        resolutions: ((1, 2)) evaluation points per cell along each side ("propagation" and "PM").
+        pattern_counts: ((1, 4)) numbers of target patterns ("GS" and "AHC").
+        precisions: (("double", "single")) precisions to run each engine in ("AHC" only runs once).
+        workloads: which benchmarks to run, any of "propagation", "PM", "GS" and "AHC".
+        k: (40kHz in air) wavenumber.
+        repeats: (3) number of timed runs of each propagation (solvers are timed once).
+        ahc_max_size: (6) largest AMM size given to "AHC", whose cost grows very quickly with size.
+        output_file: if given, the results are saved there as JSON (see "save_benchmarks").
+        verbose: (True) print each result as it is found.
+
+    returns:
+        results: list of result dicts with the parameters, "engine", "time" [s], "peak_memory" [bytes] and "error".
+
+    """
+
+    results = []
+
+    def add(records, **params):
+        for record in records:
+            record = dict(params, **record)
+            results.append(record)
+            if verbose:
+                error = "-" if record["error"] is None else "%.2e" % record["error"]
+                print(", ".join(str(key) + "=" + str(value) for key, value in params.items()), record["engine"],
+                      "time: %.4fs" % record["time"], "peak: %.1fMB" % (record["peak_memory"]/2**20), "error:", error)
+
+    for size in sizes:
+        for precision in precisions:
+
+            if "propagation" in workloads:
+                for resolution in resolutions:
+                    add(benchmark_propagation(size, resolution, precision, k, repeats=repeats), workload="propagation",
+                        size=size, resolution=resolution, precision=precision)
+
+            if "PM" in workloads:
+                for resolution in resolutions:
+                    add(benchmark_PM(size, resolution, precision, k, repeats=repeats), workload="PM", size=size,
+                        resolution=resolution, precision=precision)
+
+            if "GS" in workloads:
+                for pattern_count in pattern_counts:
+                    add(benchmark_GS(size, pattern_count, precision, k), workload="GS", size=size,
+                        pattern_count=pattern_count, precision=precision)
+
+        if "AHC" in workloads and size <= ahc_max_size:
+            for pattern_count in pattern_counts:
+                add(benchmark_AHC(size, pattern_count), workload="AHC", size=size, pattern_count=pattern_count,
+                    precision=None)
+
+    if output_file is not None:
+        save_benchmarks(results, output_file)
+
+    return results
+
+
+def save_benchmarks(results, output_file=None):
+
+    """
+
+    saves benchmark results as JSON, together with a description of the machine and libraries they ran on, to
+    output_file, or prints them to stdout if output_file is None.
+
+    """
+
+    from fft_functions import fft_settings
+
+    data = {"machine": {"platform": platform.platform(), "processor": platform.processor(),
+                        "cpu_count": os.cpu_count(), "python": platform.python_version(), "numpy": np.__version__,
+                        "fft_backend": fft_settings["backend"], "time": time.strftime("%Y-%m-%d %H:%M:%S")},
+            "results": results}
+
+    if output_file is None:
+        json.dump(data, sys.stdout, indent=1)
+        print()
+        return
+
+    with open(output_file, "w") as f:
+        json.dump(data, f, indent=1)
+
+
+def compare_benchmarks(before_file, after_file, threshold=1.1, min_time=1e-3, verbose=True):
+
+    """
+
+    compares two sets of results from "run_benchmarks" and finds the results which got slower.
+
+    args:
+        before_file, after_file: JSON files to compare, or lists of results from "run_benchmarks".
+        threshold: (1.1) ratio of after/before time above which a result counts as a regression.
+        min_time: (1e-3 [s]) results faster than this in both files are too noisy to count as regressions.
+        verbose: (True) print the time ratio of every result found in both files.
+
+    returns:
+        regressions: list of (parameters, before time, after time) for each regression.
+
+    """
+
+    def keyed(results):
+        if isinstance(results, str):
+            with open(results) as f:
+                results = json.load(f)["results"]
+        return {tuple(sorted((key, value) for key, value in result.items()
+                             if key not in ("time", "peak_memory", "error"))): result for result in results}
+
+    before, after = keyed(before_file), keyed(after_file)
+    regressions = []
+
+    for key in before:
+        if key in after:
+            ratio = after[key]["time"] / before[key]["time"]
+            if verbose:
+                print(", ".join(str(name) + "=" + str(value) for name, value in key), "time ratio: %.2f" % ratio)
+            if ratio > threshold and max(before[key]["time"], after[key]["time"]) > min_time:
+                regressions.append((dict(key), before[key]["time"], after[key]["time"]))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the ASM, GF, PM and AHC engines.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 32])
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--pattern-counts", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--precisions", nargs="+", default=["double", "single"])
+    parser.add_argument("--workloads", nargs="+", default=["propagation", "PM", "GS", "AHC"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help="JSON file to save the results to. If not given, the results are printed to "
+                        "stdout as JSON (without the progress lines).")
+    parser.add_argument("--compare", help="earlier JSON results to check the new results against for regressions.")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.resolutions, args.pattern_counts, args.precisions, args.workloads,
+                             repeats=args.repeats, output_file=args.output, verbose=args.output is not None)
+
+    if args.output is None:
+        save_benchmarks(results)
+
+    if args.compare is not None:
+        regressions = compare_benchmarks(args.compare, results, verbose=False)
+        for params, before_time, after_time in regressions:
+            print("regression:", params, "%.4fs -> %.4fs" % (before_time, after_time), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
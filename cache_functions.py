@@ -0,0 +1,241 @@
+import os
+import hashlib
+import collections
+import numpy as np
+from functions import get_precision
+
+
+class PropagatorCache:
+
+    """
+
+    Two-tier cache for propagator matrices. Recently used arrays are kept in memory (least recently used arrays are
+    evicted once max_bytes is exceeded) and, if a cache_dir is given, every array is also written to disk as a .npy
+    file. Arrays only found on disk are loaded back into memory, or memory-mapped if they are larger than max_bytes.
+
+    Arrays returned by the cache are read-only, as they are shared between callers.
+
+    args:
+        max_bytes: (2**30 [bytes]) size of the in-memory tier.
+        cache_dir: folder for the on-disk tier. If None, only the in-memory tier is used.
+
+    """
+
+    def __init__(self, max_bytes=2**30, cache_dir=None):
+
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.current_bytes = 0
+        self.hits, self.misses = 0, 0
+        self._memory = collections.OrderedDict()
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def _remember(self, key, array):
+
+        """ add an array to the in-memory tier, evicting the least recently used arrays if needed. """
+
+        if key in self._memory:
+            self.current_bytes -= self._memory.pop(key).nbytes
+
+        # arrays larger than the whole budget are only kept on disk
+        if array.nbytes > self.max_bytes:
+            return
+
+        self._memory[key] = array
+        self.current_bytes += array.nbytes
+
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+
+    def get(self, key):
+
+        """ return the array stored under key, or None if it is not cached. """
+
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            array = np.load(self._path(key), mmap_mode="r")
+            if array.nbytes <= self.max_bytes:
+                array = np.array(array)
+                array.flags.writeable = False
+                self._remember(key, array)
+            self.hits += 1
+            return array
+
+        self.misses += 1
+        return None
+
+    def put(self, key, array):
+
+        """ store an array under key and return it, made read-only (the array itself, not a copy). """
+
+        array = np.asarray(array)
+        array.flags.writeable = False
+
+        if self.cache_dir is not None:
+
+            # write to a temporary file first so that an interrupted save never leaves a corrupt entry
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, self._path(key))
+
+        self._remember(key, array)
+
+        return array
+
+    def clear(self, disk=False):
+
+        """ empty the in-memory tier, and the on-disk tier too if disk is True. """
+
+        self._memory.clear()
+        self.current_bytes = 0
+
+        if disk and self.cache_dir is not None:
+            for filename in os.listdir(self.cache_dir):
+                if filename.endswith(".npy"):
+                    os.remove(os.path.join(self.cache_dir, filename))
+
+
+default_cache = PropagatorCache()
+
+
+def propagator_key(name, *arrays, **params):
+
+    """
+
+    build a content-addressed key from the name of a builder, its array arguments and its scalar parameters.
+
+    args:
+        name: name of the propagator builder.
+        arrays: geometry arrays (points, normals, areas...). Lists of arrays are stacked before hashing.
+        params: scalar parameters such as the wavenumber.
+
+    returns:
+        key: hex digest identifying the propagator.
+
+    """
+
+    digest = hashlib.sha1(name.encode())
+
+    for array in arrays:
+        array = np.ascontiguousarray(np.asarray(array, dtype=float))
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+
+    for param_name in sorted(params):
+        value = params[param_name]
+        value = value if isinstance(value, str) else float(value)
+        digest.update((param_name + "=" + repr(value)).encode())
+
+    return digest.hexdigest()
+
+
+def cached_GF_propagator_function_builder(reflector_points, eval_points, normals, areas, k, precision=None, cache=None):
+
+    """
+
+    cached version of "GF_propagator_function_builder". Identical geometry and wavenumber return the stored H
+    instead of rebuilding it.
+
+    args:
+        reflector_points: matrix of x,y,z coords for the reflecting elements.
+        eval_points: matrix of evaluation x,y,z coords at the propagation plane.
+        normals: for a flat metasurface you get n*m times the vector [0, 0, 1].
+        areas: vector of the areas covered by each element (1, n*m).
+        k: wavenumber.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        cache: PropagatorCache to use, defaults to default_cache.
+
+    returns:
+        H: propagator function (n*m, p*q), read-only.
+
+    """
+
+    from GF_functions import GF_propagator_function_builder
+
+    cache = default_cache if cache is None else cache
+    key = propagator_key("GF", reflector_points, eval_points, normals, areas, k=k, precision=get_precision(precision))
+
+    H = cache.get(key)
+    if H is None:
+        H = cache.put(key, GF_propagator_function_builder(reflector_points, eval_points, normals, areas, k, precision))
+
+    return H
+
+
+def cached_PM_propagator_function_builder(tp_vec, sin_theta, k, p0=8.02, d=10/1000, precision=None, cache=None,
+                                          directivity="taylor"):
+
+    """
+
+    cached version of "PM_propagator_function_builder".
+
+    args:
+        tp_vec: vector of Pythagorean distances between each transducer and each evaluation point in x, y and z.
+        sin_theta: sin of angle between tran normal and vector drawn between the transducer and each evaluation point.
+        k: wavenumber.
+        p0: (8.02 [Pa]) reference pressure for Murata transducer measured at a distance of 1m.
+        d: (10/1000 [m]) diameter of transducer.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        cache: PropagatorCache to use, defaults to default_cache.
+        directivity: ("taylor") "taylor", "exact" or a measured table, see "PM_propagator_function_builder". A table
+        is part of the key, so different tables are cached separately.
+
+    returns:
+        H: piston model propagator, read-only.
+
+    """
+
+    from PM_functions import PM_propagator_function_builder
+
+    cache = default_cache if cache is None else cache
+    tables = [] if isinstance(directivity, str) else [directivity]
+    key = propagator_key("PM", tp_vec, sin_theta, *tables, k=k, p0=p0, d=d, precision=get_precision(precision),
+                         directivity=directivity if isinstance(directivity, str) else "table")
+
+    H = cache.get(key)
+    if H is None:
+        H = cache.put(key, PM_propagator_function_builder(tp_vec, sin_theta, k, p0, d, precision, directivity))
+
+    return H
+
+
+def cached_pesb_hex(evpd, resolution, coords, precision=None, cache=None):
+
+    """
+
+    cached version of "hex.pesb_hex".
+
+    args:
+        evpd: side length of the evaluation plane [m].
+        resolution: number of evaluation points along each side.
+        coords: list of (x, y, z) transducer coords.
+        precision: "single" or "double", defaults to the library-wide setting (see functions.set_precision).
+        cache: PropagatorCache to use, defaults to default_cache.
+
+    returns:
+        rxyz, rxy: xyz and xy distances between each transducer and evaluation point, read-only.
+
+    """
+
+    from hex import pesb_hex
+
+    cache = default_cache if cache is None else cache
+    key = propagator_key("pesb_hex", coords, evpd=evpd, resolution=resolution, precision=get_precision(precision))
+
+    rxyz, rxy = cache.get(key + "_rxyz"), cache.get(key + "_rxy")
+    if rxyz is None or rxy is None:
+        rxyz, rxy = pesb_hex(evpd, resolution, coords, precision)
+        rxyz, rxy = cache.put(key + "_rxyz", rxyz), cache.put(key + "_rxy", rxy)
+
+    return rxyz, rxy
@@ -0,0 +1,245 @@
+import numpy as np
+
+
+class LowRankPropagator:
+
+    """
+
+    Propagator stored as the product of two thin matrices, H = U @ V, so that memory and matvec cost scale with the
+    rank instead of the full size of H. It supports the operations used by "GF_prop" and "GFGS" (@ on either side,
+    .conj() and .T), so it can be passed wherever a dense H is expected.
+
+    args:
+        U: (n, rank) array.
+        V: (rank, p) array.
+
+    """
+
+    # make numpy defer "array @ propagator" to __rmatmul__
+    __array_ufunc__ = None
+
+    def __init__(self, U, V):
+
+        self.U, self.V = U, V
+
+    @property
+    def shape(self):
+        return (self.U.shape[0], self.V.shape[1])
+
+    @property
+    def dtype(self):
+        return np.result_type(self.U, self.V)
+
+    @property
+    def rank(self):
+        return self.U.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.U.nbytes + self.V.nbytes
+
+    @property
+    def T(self):
+        return LowRankPropagator(self.V.T, self.U.T)
+
+    def conj(self):
+        return LowRankPropagator(np.conj(self.U), np.conj(self.V))
+
+    def __matmul__(self, x):
+        return self.U @ (self.V @ x)
+
+    def __rmatmul__(self, x):
+        return (x @ self.U) @ self.V
+
+    def toarray(self):
+        return self.U @ self.V
+
+
+class BlockPropagator:
+
+    """
+
+    Propagator split into blocks of columns (axis=1) or rows (axis=0), each stored either densely or as a
+    LowRankPropagator. This lets every block of evaluation points use its own rank.
+
+    args:
+        blocks: list of dense arrays or LowRankPropagators.
+        axis: (1) 1 if the blocks are side by side (column blocks), 0 if they are stacked (row blocks).
+
+    """
+
+    __array_ufunc__ = None
+
+    def __init__(self, blocks, axis=1):
+
+        self.blocks, self.axis = blocks, axis
+        self.edges = np.cumsum([0] + [block.shape[axis] for block in blocks])
+
+    @property
+    def shape(self):
+        other = self.blocks[0].shape[1 - self.axis]
+        return (other, int(self.edges[-1])) if self.axis == 1 else (int(self.edges[-1]), other)
+
+    @property
+    def dtype(self):
+        return np.result_type(*[block.dtype for block in self.blocks])
+
+    @property
+    def nbytes(self):
+        return sum(block.nbytes for block in self.blocks)
+
+    @property
+    def T(self):
+        return BlockPropagator([block.T for block in self.blocks], 1 - self.axis)
+
+    def conj(self):
+        return BlockPropagator([block.conj() for block in self.blocks], self.axis)
+
+    def __matmul__(self, x):
+
+        # column blocks each act on a slice of x, row blocks each give a slice of the result
+        if self.axis == 1:
+            return sum(block @ x[self.edges[i]:self.edges[i + 1]] for i, block in enumerate(self.blocks))
+        return np.concatenate([block @ x for block in self.blocks], axis=0)
+
+    def __rmatmul__(self, x):
+
+        if self.axis == 1:
+            return np.concatenate([x @ block for block in self.blocks], axis=-1)
+        return sum(x[..., self.edges[i]:self.edges[i + 1]] @ block for i, block in enumerate(self.blocks))
+
+    def toarray(self):
+        return np.concatenate([block.toarray() if isinstance(block, LowRankPropagator) else block
+                               for block in self.blocks], axis=self.axis)
+
+
+def randomized_svd_compress(H, tol=1e-6, max_rank=None, oversampling=10, power_iterations=2, initial_rank=16):
+
+    """
+
+    compresses a dense propagator with a randomized SVD. The sketch size is doubled until the singular values of
+    the sketch drop below tol (relative to the largest one).
+
+    args:
+        H: dense (n, p) propagator.
+        tol: (1e-6) relative singular value at which the rank is truncated.
+        max_rank: largest rank to try, defaults to min(n, p).
+        oversampling: (10) extra sketch vectors beyond the target rank.
+        power_iterations: (2) subspace iterations, which sharpen the sketch for slowly decaying spectra.
+        initial_rank: (16) first rank to try.
+
+    returns:
+        LowRankPropagator approximating H.
+
+    """
+
+    max_rank = min(H.shape) if max_rank is None else min(max_rank, min(H.shape))
+    rng = np.random.default_rng(0)
+    rank = min(initial_rank, max_rank)
+
+    while True:
+
+        sketch_size = min(rank + oversampling, min(H.shape))
+        omega = rng.standard_normal((H.shape[1], sketch_size)).astype(H.dtype)
+
+        # orthonormal basis for the range of H, refined by power iterations
+        Q, _ = np.linalg.qr(H @ omega)
+        for _ in range(power_iterations):
+            Q, _ = np.linalg.qr(np.conj(H.T) @ Q)
+            Q, _ = np.linalg.qr(H @ Q)
+
+        u, s, vh = np.linalg.svd(np.conj(Q.T) @ H, full_matrices=False)
+        converged = s[-1] <= tol*s[0] or sketch_size == min(H.shape)
+
+        if converged or rank >= max_rank:
+            break
+        rank = min(2*rank, max_rank)
+
+    keep = min(max(1, int(np.count_nonzero(s > tol*s[0]))), max_rank)
+
+    return LowRankPropagator((Q @ u[:, :keep]) * s[:keep], vh[:keep])
+
+
+def aca_compress(get_row, get_col, shape, tol=1e-6, max_rank=None, dtype=complex):
+
+    """
+
+    compresses a propagator with partially pivoted adaptive cross approximation. Only the rows and columns chosen
+    as pivots are ever evaluated, so H never has to be built.
+
+    args:
+        get_row: function returning row i of H as a (p) vector.
+        get_col: function returning column j of H as a (n) vector.
+        shape: (n, p) shape of H.
+        tol: (1e-6) relative Frobenius norm of the last cross at which the approximation stops.
+        max_rank: largest rank, defaults to min(n, p).
+        dtype: (complex) dtype of H.
+
+    returns:
+        LowRankPropagator approximating H.
+
+    """
+
+    max_rank = min(shape) if max_rank is None else min(max_rank, min(shape))
+    U, V = np.zeros((shape[0], max_rank), dtype=dtype), np.zeros((max_rank, shape[1]), dtype=dtype)
+    unused_rows = np.ones(shape[0], dtype=bool)
+    norm2, rank, i = 0.0, 0, 0
+
+    while rank < max_rank and unused_rows.any():
+
+        unused_rows[i] = False
+
+        # residual of row i, and the column where it peaks
+        row = get_row(i) - U[i, :rank] @ V[:rank]
+        j = np.argmax(abs(row))
+
+        if row[j] == 0:
+            i = np.flatnonzero(unused_rows)[0] if unused_rows.any() else i
+            continue
+
+        col = get_col(j) - U[:, :rank] @ V[:rank, j]
+        U[:, rank], V[rank] = col, row/row[j]
+
+        # update the Frobenius norm of the approximation with the new cross
+        u_norm2, v_norm2 = np.vdot(U[:, rank], U[:, rank]).real, np.vdot(V[rank], V[rank]).real
+        cross_terms = (np.conj(U[:, :rank].T) @ U[:, rank]) * (np.conj(V[:rank]) @ V[rank])
+        norm2 += u_norm2*v_norm2 + 2*np.sum(cross_terms.real)
+        rank += 1
+
+        if np.sqrt(u_norm2*v_norm2) <= tol*np.sqrt(norm2):
+            break
+
+        # the next pivot row is where the new column peaks
+        i = np.flatnonzero(unused_rows)[np.argmax(abs(U[unused_rows, rank - 1]))] if unused_rows.any() else i
+
+    return LowRankPropagator(U[:, :rank].copy(), V[:rank].copy())
+
+
+def compress_propagator(H, tol=1e-6, block_length=None, max_rank=None):
+
+    """
+
+    compresses a dense propagator (e.g. from "PM_propagator" or "GF_propagator_function_builder") with a randomized
+    SVD, either globally or per block of evaluation points. Blocks which do not compress are kept dense.
+
+    args:
+        H: dense (n, p) propagator.
+        tol: (1e-6) relative singular value at which the rank is truncated.
+        block_length: number of evaluation points (columns) per block. If None, H is compressed as one block.
+        max_rank: largest rank of any block.
+
+    returns:
+        LowRankPropagator, or a BlockPropagator if block_length is given.
+
+    """
+
+    if block_length is None:
+        return randomized_svd_compress(H, tol, max_rank)
+
+    blocks = []
+    for start in range(0, H.shape[1], block_length):
+        block = H[:, start:start + block_length]
+        compressed = randomized_svd_compress(block, tol, max_rank)
+        blocks.append(compressed if compressed.nbytes < block.nbytes else np.array(block))
+
+    return BlockPropagator(blocks)
@@ -0,0 +1,176 @@
+import os
+import numpy as np
+
+
+fft_settings = {"backend": "scipy", "workers": -1, "planner_effort": "FFTW_MEASURE"}
+
+# FFTW plans (and their aligned buffers) for each (shape, dtype, axes, direction), only used by the pyfftw backend
+fftw_plans = {}
+
+# np.fft only takes an output array from NumPy 2.0
+numpy_fft_out = np.lib.NumpyVersion(np.__version__) >= "2.0.0"
+
+
+def set_fft_backend(backend, workers=-1, planner_effort="FFTW_MEASURE"):
+
+    """
+
+    Selects the FFT library used by the ASM functions.
+
+    args:
+        backend: "numpy" (np.fft, single-threaded), "scipy" (scipy.fft, multi-threaded, the default) or "pyfftw"
+        (FFTW plans with wisdom, needs pyFFTW installed).
+        workers: (-1) number of threads for "scipy" and "pyfftw", -1 uses every core.
+        planner_effort: ("FFTW_MEASURE") FFTW planner flag for "pyfftw".
+
+    """
+
+    if backend not in ("numpy", "scipy", "pyfftw"):
+        raise ValueError(str(backend) + " is not a valid FFT backend, please specify 'numpy', 'scipy' or 'pyfftw'.")
+
+    if backend == "pyfftw":
+        import pyfftw
+
+    fft_settings.update(backend=backend, workers=workers, planner_effort=planner_effort)
+    fftw_plans.clear()
+
+
+def fftw_plan(shape, dtype, axes, direction):
+
+    """ returns a cached pyFFTW plan with its own aligned input and output buffers. """
+
+    import pyfftw
+
+    key = (shape, np.dtype(dtype).str, axes, direction, fft_settings["workers"], fft_settings["planner_effort"])
+
+    if key not in fftw_plans:
+        threads = os.cpu_count() if fft_settings["workers"] == -1 else fft_settings["workers"]
+        input_array = pyfftw.empty_aligned(shape, dtype=dtype)
+        output_array = pyfftw.empty_aligned(shape, dtype=dtype)
+        fftw_plans[key] = pyfftw.FFTW(input_array, output_array, axes=axes, direction=direction, threads=threads,
+                                      flags=(fft_settings["planner_effort"],))
+
+    return fftw_plans[key]
+
+
+def fftn(a, axes, inverse=False, out=None, overwrite_input=False):
+
+    """
+
+    N-dimensional (inverse) FFT over the given axes with the current backend.
+
+    args:
+        a: complex input array.
+        axes: tuple of axes to transform.
+        inverse: if True, the normalised inverse FFT is computed.
+        out: optional preallocated output array of the same shape and dtype as a (may be a itself, for an in-place
+        transform). The "numpy" (NumPy >= 2.0) and "scipy" backends transform straight into it without allocating
+        a result, "pyfftw" copies the result of its plan into it.
+        overwrite_input: if True, the backend may overwrite a ("scipy" then transforms complex input in place).
+
+    returns:
+        transformed array (out, if it was given).
+
+    """
+
+    a = np.asarray(a)
+    backend = fft_settings["backend"]
+
+    if backend == "pyfftw":
+
+        dtype = np.result_type(a, np.complex64)
+        plan = fftw_plan(a.shape, dtype, tuple(ax % a.ndim for ax in axes), "FFTW_BACKWARD" if inverse else "FFTW_FORWARD")
+        plan.input_array[...] = a
+        plan.execute()
+
+        # FFTW does not normalise its inverse transform
+        if inverse:
+            plan.output_array /= np.prod([a.shape[ax] for ax in axes])
+
+        # the plan's buffers are reused by the next call, so hand back a copy unless an output buffer was given
+        if out is None:
+            return plan.output_array.copy()
+        out[...] = plan.output_array
+        return out
+
+    if backend == "scipy":
+
+        import scipy.fft
+        transform = scipy.fft.ifftn if inverse else scipy.fft.fftn
+
+        # scipy.fft has no output argument, but transforms complex input in place when allowed to overwrite it, so
+        # the input is copied into out (unless it already is out) and transformed there
+        if out is not None:
+            if out is not a:
+                out[...] = a
+            a, overwrite_input = out, True
+
+        result = transform(a, axes=axes, workers=fft_settings["workers"], overwrite_x=overwrite_input)
+
+    elif numpy_fft_out:
+        return (np.fft.ifftn if inverse else np.fft.fftn)(a, axes=axes, out=out)
+
+    else:
+        result = (np.fft.ifftn if inverse else np.fft.fftn)(a, axes=axes)
+
+    if out is None:
+        return result
+
+    # an in-place transform hands back a view of out
+    if not np.shares_memory(result, out):
+        out[...] = result
+    return out
+
+
+def fft2(a, axes=(-2, -1), out=None, overwrite_input=False):
+
+    """ 2D FFT over the last two axes (batched over any leading axes), see "fftn". """
+
+    return fftn(a, axes, False, out, overwrite_input)
+
+
+def ifft2(a, axes=(-2, -1), out=None, overwrite_input=False):
+
+    """ 2D inverse FFT over the last two axes (batched over any leading axes), see "fftn". """
+
+    return fftn(a, axes, True, out, overwrite_input)
+
+
+def ifft(a, axis=-1, out=None, overwrite_input=False):
+
+    """ 1D inverse FFT along one axis, see "fftn". """
+
+    return fftn(a, (axis,), True, out, overwrite_input)
+
+
+def next_fast_len(n):
+
+    """ smallest length >= n that the current backend transforms quickly (products of small primes). """
+
+    if fft_settings["backend"] == "numpy":
+        return int(n)
+
+    import scipy.fft
+    return scipy.fft.next_fast_len(int(n))
+
+
+def export_wisdom(filename):
+
+    """ saves the accumulated FFTW wisdom (pyfftw backend), so that later sessions skip planning. """
+
+    import pyfftw
+    import pickle
+
+    with open(filename, "wb") as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
+
+
+def import_wisdom(filename):
+
+    """ loads FFTW wisdom saved with "export_wisdom" (pyfftw backend). """
+
+    import pyfftw
+    import pickle
+
+    with open(filename, "rb") as f:
+        pyfftw.import_wisdom(pickle.load(f))
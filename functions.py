@@ -8,6 +8,56 @@ import math as math
 from scipy.special import comb
 
 
+precision_settings = {"precision": "double"}
+
+
+def set_precision(precision):
+    
+    """
+    
+    Sets the library-wide floating point precision used by the GF, ASM and PM propagators. Every function that takes
+    a "precision" argument uses this setting when its argument is left as None.
+    
+    "single" keeps propagators, cached H matrices and FFTs in float32/complex64, halving memory and bandwidth.
+    With unit roundoff u = 6e-8, the relative error against the "double" path is bounded by roughly:
+        GF/PM propagators: 2*u*k*r_max in the phase of each element of H (e.g. 2e-5 rad at 40kHz and r = 0.2m),
+        and N*u in a propagated field summed over N elements (typically sqrt(N)*u, i.e. 1e-5 to 1e-4).
+        ASM: u*log2(Nfft) from the FFTs, plus u*|kz|*target_dist in the phase of the propagator.
+    These are far below the quality thresholds of our acoustic targets, but phase errors grow linearly with k*r, so
+    very long propagation distances (thousands of wavelengths) should stay in "double".
+    
+    args:
+        precision: "single" or "double".
+    
+    """
+    
+    if precision not in ("single", "double"):
+        raise ValueError(str(precision) + " is not a valid precision, please specify either 'single' or 'double'.")
+        
+    precision_settings["precision"] = precision
+    
+    
+def get_precision(precision=None):
+    
+    """ return precision if it is given, otherwise the library-wide setting. """
+    
+    return precision_settings["precision"] if precision is None else precision
+    
+    
+def real_dtype(precision=None):
+    
+    """ float dtype for a precision (float32 for "single", float64 for "double"). """
+    
+    return np.dtype(np.float32) if get_precision(precision) == "single" else np.dtype(np.float64)
+    
+    
+def complex_dtype(precision=None):
+    
+    """ complex dtype for a precision (complex64 for "single", complex128 for "double"). """
+    
+    return np.dtype(np.complex64) if get_precision(precision) == "single" else np.dtype(np.complex128)
+
+
 def points_vector_builder(centrepoint, extents, pixel_spacing):
     
     """
@@ -300,6 +350,59 @@ def focus_phasemap_builder(points, focal_point_coords, k, focal_point_phase = 0)
     norm_phase_array = np.remainder(total_phase_array, 2*np.pi) - np.pi
     
     return norm_phase_array
+
+
+def focus_phasemap_builder_batch(points, focal_points, k, focal_point_phases=0, superpose=False, max_memory=2**28):
+
+    """
+    Builds the phasemaps of many foci at once (e.g. a trajectory or a 3D grid of foci), with the same conventions
+    as "focus_phasemap_builder". The foci are processed in chunks within a memory budget.
+
+    args:
+        points: (N, 3) matrix describing the postitions of elements on the AMM or PAT surface.
+        focal_points: (F, 3) coords of the foci.
+        k: wavenumber
+        focal_point_phases: (0) phase of each focus, a scalar or (F) array.
+        superpose: if True, the foci are superposed into a single multi-focus phasemap (the phase of the sum of
+        every single-focus field).
+        max_memory: (2**28 [bytes]) memory budget for the temporaries of each chunk of foci.
+        
+    returns:
+        norm_phase_array: (F, N) phase delays from -pi to pi, one phasemap per focus, or (N) if superpose is True.
+
+    """
+
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    focal_points = np.asarray(focal_points, dtype=float).reshape(-1, 3)
+    focal_point_phases = np.broadcast_to(np.asarray(focal_point_phases, dtype=float), (len(focal_points),))
+
+    chunk_length = max(1, int(max_memory / (32*len(points))))
+    norm_phase_array = np.zeros(len(points), dtype=complex) if superpose else \
+        np.empty((len(focal_points), len(points)))
+
+    for start in range(0, len(focal_points), chunk_length):
+
+        chunk = slice(start, start + chunk_length)
+
+        # matrix of distances from centre of each elem to each focus in the chunk. float_power rounds like the
+        # scalar ** of "focus_phasemap_builder", so a single focus gives exactly the same phasemap
+        travel_distance_array = np.sqrt(np.float_power(points[None, :, 0] + focal_points[chunk, 0, None], 2) + \
+                                        np.float_power(points[None, :, 1] + focal_points[chunk, 1, None], 2) + \
+                                        np.float_power(points[None, :, 2] + focal_points[chunk, 2, None], 2))
+
+        # total change in phase of waves as they travel this distance, normalised between -π and π [rads].
+        total_phase_array = focal_point_phases[chunk, None] - travel_distance_array * k
+        chunk_phase_array = np.remainder(total_phase_array, 2*np.pi) - np.pi
+
+        if superpose:
+            norm_phase_array += np.sum(np.exp(1j*chunk_phase_array), axis=0)
+        else:
+            norm_phase_array[chunk] = chunk_phase_array
+
+    if superpose:
+        norm_phase_array = np.remainder(np.angle(norm_phase_array) + np.pi, 2*np.pi) - np.pi
+
+    return norm_phase_array
      
     
 # def focus_phasemap_builder(points, focal_point_coords, k, focal_point_phase = 0):
@@ -399,4 +502,33 @@ def brickmap_builder(phasemap, discretisation):
                 current = brick_phase  # redefine dummy variable as closest discrete phase delay
         brickmap.append(db.index(current))  # discretised phase-delay map for each element
     brickmap = np.array(brickmap).reshape((m, n))  # reshape by into m-by-n matrix
-    return brickmap
\ No newline at end of file
+    return brickmap
+
+def chunked_dot(vectors, matrix, max_memory=2**28):
+    
+    """
+    
+    find the product of a stack of vectors and a matrix, one chunk of vectors at a time, so that the product is done
+    as a few matrix-matrix products rather than many matrix-vector products without exceeding a memory budget.
+    
+    args:
+        vectors: (batch, n) array, or a single (n) vector.
+        matrix: (n, p) array, or any propagator supporting @ (e.g. compression_functions.LowRankPropagator).
+        max_memory: (2**28 [bytes]) memory budget for the output of each chunk.
+        
+    returns:
+        product: (batch, p) array, or a (p) vector for a single input vector.
+    
+    """
+    
+    if np.ndim(vectors) == 1:
+        return vectors @ matrix
+    
+    out_dtype = np.result_type(vectors.dtype, matrix.dtype)
+    product = np.empty((vectors.shape[0], matrix.shape[1]), dtype=out_dtype)
+    chunk_length = max(1, int(max_memory // (out_dtype.itemsize * matrix.shape[1])))
+    
+    for start in range(0, vectors.shape[0], chunk_length):
+        product[start:start + chunk_length] = vectors[start:start + chunk_length] @ matrix
+        
+    return product
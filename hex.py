@@ -1,4 +1,5 @@
 import sys, numpy as np
+from functions import real_dtype
 
 def hexagon_diameter_to_coordinates( d, 
                                     x_spacing = 10.5/1000,
@@ -53,19 +54,30 @@ def hexagon_diameter_to_coordinates( d,
 
 
 
-def pesb_hex( evpd, resolution, coords ) -> tuple:
+def pesb_hex( evpd, resolution, coords, precision = None ) -> tuple:
+    """
+    Pressure evaluation space builder for a hexagonal PAT
+
+    Args:
+        evpd:       side length of the square evaluation plane [m]
+        resolution: number of evaluation points along each side
+        coords:     transducer coordinates from hexagon_diameter_to_coordinates
+        precision:  "single" or "double", defaults to the library-wide setting (see functions.set_precision)
+    """
+
+    real = real_dtype( precision )
 
-    tx = np.array([coord[0] for coord in coords], dtype=float)
-    ty = np.array([coord[1] for coord in coords], dtype=float)
-    tz = np.array([coord[2] for coord in coords], dtype=float)
+    tx = np.array([coord[0] for coord in coords], dtype=real)
+    ty = np.array([coord[1] for coord in coords], dtype=real)
+    tz = np.array([coord[2] for coord in coords], dtype=real)
 
     # building evaluation plane points
-    ev = np.linspace( -evpd/2, evpd/2, resolution ) # create vector with desired resolution
+    ev = np.linspace( -evpd/2, evpd/2, resolution, dtype=real ) # create vector with desired resolution
     ex, ey = np.meshgrid(ev, ev)
 
     # x, y & z vectors for evaluation-plane sample points:
     px, py = ex.flatten(), ey.flatten()
-    pz = np.zeros(len(ex)*len(ey))
+    pz = np.zeros(len(ex)*len(ey), dtype=real)
 
     # Grids to describe the vector distances between each transducer & evaluation plane sample point.
     txv, pxv = np.meshgrid(tx, px)
@@ -0,0 +1,180 @@
+import json
+import numpy as np
+from functions import focus_phasemap_builder_batch
+
+
+class SteeringTable:
+
+    """
+
+    Precomputed beam-steering table: the focus phasemap (see functions.focus_phasemap_builder) of every point of a
+    regular 3D grid of focal positions, stored on disk as complex64 phasors exp(1j*phase) in a memory-mapped .npy
+    file. Phasemaps for focal positions between grid points are found by trilinear interpolation of the phasors,
+    which interpolates in the circular domain (phases never wrap the wrong way around).
+
+    Build a table with "steering_table_builder"; SteeringTable(filename) opens an existing one.
+
+    args:
+        filename: .npy file of the table. Its grid is described by a JSON file of the same name (.json).
+
+    """
+
+    def __init__(self, filename):
+
+        with open(filename[:-4] + ".json") as f:
+            self.meta = json.load(f)
+
+        # plain ndarray view of the memory map, which is much cheaper to slice than the np.memmap itself
+        self.table = np.asarray(np.load(filename, mmap_mode="r"))
+        self.origin = np.array([axis["start"] for axis in self.meta["axes"]])
+        self.step = np.array([axis["step"] for axis in self.meta["axes"]])
+        self.counts = np.array([axis["count"] for axis in self.meta["axes"]])
+        self._grid = [(axis["start"], axis["step"], axis["count"]) for axis in self.meta["axes"]]
+
+    @property
+    def max_phase_error(self):
+
+        """ worst phase error [rad] of the interpolation, measured over a sample of cells when the table was built. """
+
+        return self.meta["max_phase_error"]
+
+    def _query_single(self, focal_point):
+
+        """ fast path of "query" for a single focus: one 2x2x2 block of the table is read and blended. """
+
+        block, below, above = [], [], []
+
+        # done on Python floats, as NumPy's per-call overhead would dominate for a single point
+        for axis in range(3):
+            origin, step, count = self._grid[axis]
+            position = min(max((float(focal_point[axis]) - origin) / step, 0.0), count - 1)
+            index = min(int(position), count - 2)
+            block.append(slice(index, index + 2))
+            above.append(position - index)
+            below.append(1 - above[-1])
+
+        weights = np.array([x*y*z for x in (below[0], above[0]) for y in (below[1], above[1])
+                            for z in (below[2], above[2])], dtype=np.float32)
+        phasors = weights @ self.table[tuple(block)].reshape(8, -1)
+
+        return np.angle(phasors)
+
+    def query(self, focal_points):
+
+        """
+
+        interpolated phasemap for one focal position, or a stack of them. Positions outside the grid are clamped to
+        its edges.
+
+        args:
+            focal_points: (3) or (Q, 3) coords of the foci, with the convention of focus_phasemap_builder.
+
+        returns:
+            norm_phase_array: (N) or (Q, N) float32 phase delays from -pi to pi.
+
+        """
+
+        focal_points = np.asarray(focal_points, dtype=float)
+        single = focal_points.ndim == 1
+
+        if single and self.table.shape[0] > 1 and self.table.shape[1] > 1 and self.table.shape[2] > 1:
+            return self._query_single(focal_points)
+
+        focal_points = focal_points.reshape(-1, 3)
+
+        # grid cell of each focus and the fractional position inside it, along each axis
+        position = np.clip((focal_points - self.origin) / self.step, 0, self.counts - 1)
+        index = np.minimum(position.astype(np.intp), np.maximum(self.counts - 2, 0))
+        fraction = (position - index).astype(np.float32)
+
+        phasors = 0
+        for corner in np.ndindex(2, 2, 2):
+            weight = np.prod(np.where(corner, fraction, 1 - fraction), axis=1)
+            corner_index = np.minimum(index + corner, self.counts - 1)
+            phasors = phasors + weight[:, None]*self.table[corner_index[:, 0], corner_index[:, 1], corner_index[:, 2]]
+
+        norm_phase_array = np.angle(phasors)
+
+        return norm_phase_array[0] if single else norm_phase_array
+
+
+def steering_table_builder(filename, points, k, x_values, y_values, z_values, focal_point_phase=0, max_memory=2**28,
+                           error_samples=1000):
+
+    """
+
+    builds a steering table (see "SteeringTable") over a regular grid of focal positions and writes it to disk.
+    The worst-case phase error of the interpolation is then measured against the exact phasemaps, over a sample of
+    the grid cells.
+
+    args:
+        filename: .npy file to write the table to (a .json file describing the grid is written next to it).
+        points: (N, 3) matrix describing the postitions of elements on the AMM or PAT surface.
+        k: wavenumber.
+        x_values, y_values, z_values: evenly spaced focal coords along each axis, with the convention of
+        functions.focus_phasemap_builder.
+        focal_point_phase: (0) phase of the focus.
+        max_memory: (2**28 [bytes]) memory budget for each chunk of phasemaps.
+        error_samples: (1000) number of randomly chosen cells (besides the corner cells of the grid) at which the
+        interpolation error is measured.
+
+    returns:
+        SteeringTable: the table, opened from disk. Its max_phase_error is the measured worst-case error [rad].
+
+    """
+
+    if not filename.endswith(".npy"):
+        raise ValueError("the steering table must be saved to a .npy file.")
+
+    axes = [np.asarray(values, dtype=float).reshape(-1) for values in (x_values, y_values, z_values)]
+    meta = {"k": float(k), "focal_point_phase": float(focal_point_phase), "axes": []}
+
+    for values in axes:
+        step = (values[-1] - values[0]) / (len(values) - 1) if len(values) > 1 else 1.0
+        if not np.allclose(np.diff(values), step):
+            raise ValueError("the focal coords along each axis must be evenly spaced.")
+        meta["axes"].append({"start": float(values[0]), "step": float(step), "count": len(values)})
+
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    table = np.lib.format.open_memmap(filename, mode="w+", dtype=np.complex64,
+                                      shape=(len(axes[0]), len(axes[1]), len(axes[2]), len(points)))
+
+    # fill the table one x slice of the grid at a time
+    for i, x in enumerate(axes[0]):
+        yy, zz = np.meshgrid(axes[1], axes[2], indexing="ij")
+        focal_points = np.stack((np.full(yy.size, x), yy.ravel(), zz.ravel()), axis=1)
+        phases = focus_phasemap_builder_batch(points, focal_points, k, focal_point_phase, max_memory=max_memory)
+        table[i] = np.exp(1j*phases).reshape(len(axes[1]), len(axes[2]), len(points))
+
+    table.flush()
+    del table
+
+    with open(filename[:-4] + ".json", "w") as f:
+        json.dump(meta, f, indent=1)
+
+    steering_table = SteeringTable(filename)
+
+    # worst-case error. Blending two phasors is exact halfway between them but not elsewhere, so each sampled cell
+    # is checked at fractions 0.2, 0.5 and 0.8 of the way across it along each axis. The corner cells of the grid,
+    # where the phase changes fastest between grid points, are always sampled
+    cells = np.maximum(steering_table.counts - 1, 1)
+    corners = np.stack(np.meshgrid(*[[0, n - 1] for n in cells], indexing="ij"), axis=-1).reshape(-1, 3)
+    corners = np.concatenate((corners, np.random.default_rng(0).integers(0, cells, size=(error_samples, 3))))
+    fractions = np.stack(np.meshgrid(*[[0.2, 0.5, 0.8]]*3, indexing="ij"), axis=-1).reshape(-1, 3)
+    fractions = fractions*(steering_table.counts > 1)
+    samples = steering_table.origin + ((corners[:, None] + fractions[None]).reshape(-1, 3))*steering_table.step
+
+    max_error = 0.0
+    chunk_length = max(1, int(max_memory / (64*len(points))))
+    for start in range(0, len(samples), chunk_length):
+        chunk = samples[start:start + chunk_length]
+        exact = focus_phasemap_builder_batch(points, chunk, k, focal_point_phase, max_memory=max_memory)
+        error = abs(np.angle(np.exp(1j*(steering_table.query(chunk) - exact))))
+        max_error = max(max_error, float(error.max()))
+
+    meta["max_phase_error"] = max_error
+    with open(filename[:-4] + ".json", "w") as f:
+        json.dump(meta, f, indent=1)
+    steering_table.meta = meta
+
+    return steering_table
@@ -0,0 +1,145 @@
+import numpy as np
+import pytest
+from ASM_functions import ASM_prop_points, ASM_fw, ASM_bw, ASM_padding, ASM_Iterative_GS
+from fft_functions import next_fast_len
+
+
+k = 2*np.pi*40000/343
+cell_spacing = 343/40000/2
+
+
+def random_surface(N=16, seed=0):
+    
+    return np.exp(1j*np.random.default_rng(seed).uniform(0, 2*np.pi, (N, N)))
+
+
+def test_ASM_prop_points_matches_band_limited_ASM_fw():
+    
+    surface, target_dist = random_surface(), 0.05
+    N = len(surface)
+    
+    # the window ASM_prop_points pads the surface to
+    M = next_fast_len(N + sum(ASM_padding(surface.shape, cell_spacing, target_dist, k)[0]))
+    M += M % 2
+    corner = (M - N) // 2
+    padded = np.zeros((M, M), dtype=complex)
+    padded[corner:corner + N, corner:corner + N] = surface
+    expected = ASM_fw(padded, cell_spacing, target_dist, k, band_limit=True)
+    
+    coords = (np.arange(M) - corner - (N - 1)/2)*cell_spacing
+    xx, yy = np.meshgrid(coords, coords)
+    points = np.stack((xx.ravel(), yy.ravel(), np.full(M*M, target_dist)), axis=1)
+    pressure = ASM_prop_points(surface, cell_spacing, points, k, target_dist=target_dist, method="direct")
+    
+    np.testing.assert_allclose(pressure.reshape(M, M), expected, atol=1e-12*abs(expected).max())
+    
+    
+def test_ASM_prop_points_does_not_depend_on_other_points():
+    
+    surface = random_surface()
+    point = np.array([[0.01, -0.02, 0.05]])
+    others = np.array([[0.0, 0.0, 0.001], [0.05, 0.05, 0.3], [-0.08, 0.03, 0.1]])
+    
+    alone = ASM_prop_points(surface, cell_spacing, point, k, method="direct")
+    together = ASM_prop_points(surface, cell_spacing, np.concatenate((point, others)), k, method="direct")
+    
+    np.testing.assert_allclose(together[0], alone[0], rtol=1e-10)
+    
+    
+def test_ASM_prop_points_points_outside_the_window():
+    
+    with pytest.raises(ValueError):
+        ASM_prop_points(random_surface(), cell_spacing, [[1.0, 0.0, 0.05]], k)
+        
+        
+@pytest.mark.parametrize("precision", ["single", "double"])
+def test_ASM_prop_points_nufft(precision):
+    
+    pytest.importorskip("finufft")
+    
+    surface = random_surface()
+    points = np.random.default_rng(1).uniform([-0.05, -0.05, 0.001], [0.05, 0.05, 0.1], (200, 3))
+    
+    direct = ASM_prop_points(surface, cell_spacing, points, k, method="direct", precision=precision)
+    nufft = ASM_prop_points(surface, cell_spacing, points, k, method="nufft", precision=precision)
+    
+    assert nufft.dtype == direct.dtype == (np.complex64 if precision == "single" else np.complex128)
+    np.testing.assert_allclose(nufft, direct, atol=(1e-4 if precision == "single" else 1e-8)*abs(direct).max())
+    
+    
+def test_ASM_prop_points_single_precision():
+    
+    pressure = ASM_prop_points(random_surface(), cell_spacing, [[0.01, 0.0, 0.05]], k, method="direct",
+                               precision="single")
+    
+    assert pressure.dtype == np.complex64
+
+    
+def test_ASM_Iterative_GS_fixed_padding_uses_the_full_propagator():
+    
+    target = (np.random.default_rng(2).random((12, 12)) > 0.6).astype(float)
+    target_dist, iterations = 0.05, 5
+    
+    # the GS loop with 3x padding and no band limit
+    padded_target = np.pad(target, 12)
+    padded_aperture = np.pad(np.ones((12, 12)), 12)
+    tpp = padded_target*np.exp(1j*padded_target*np.pi)
+    for it in range(iterations):
+        lpp = ASM_bw(tpp, cell_spacing, target_dist, k)
+        lpp = padded_aperture*np.exp(1j*np.angle(lpp)*padded_aperture)
+        tpp = ASM_fw(lpp, cell_spacing, target_dist, k)
+        tpp = padded_target*np.exp(1j*np.angle(tpp)*padded_target)
+    lpp = ASM_bw(tpp, cell_spacing, target_dist, k)
+    expected = (padded_aperture*np.exp(1j*np.angle(lpp)*padded_aperture))[12:24, 12:24]
+    
+    lpp = ASM_Iterative_GS(target, np.ones((12, 12)), iterations, cell_spacing, target_dist, k, padding="fixed")
+    
+    np.testing.assert_allclose(lpp, expected, atol=1e-12)
+    
+    
+def test_ASM_padding_gives_even_lengths():
+    
+    # a 34x34 aperture at 25-70 mm would otherwise be padded to next_fast_len(102) = 105
+    for target_dist in (0.025, 0.05, 0.07):
+        pw = ASM_padding((34, 33), cell_spacing, target_dist, k)
+        assert [(N + sum(widths)) % 2 for N, widths in zip((34, 33), pw)] == [0, 0]
+        
+    surface = random_surface(34)
+    pw = ASM_padding(surface.shape, cell_spacing, 0.025, k)
+    padded = np.pad(surface, pw)
+    
+    # the propagator on the true FFT frequencies
+    kx = 2*np.pi*np.fft.fftfreq(padded.shape[0], cell_spacing)
+    kz = np.lib.scimath.sqrt(k**2 - kx[:, None]**2 - kx[None, :]**2)
+    expected = np.fft.ifft2(np.fft.fft2(padded)*np.exp(1j*kz*0.025))
+    
+    np.testing.assert_allclose(ASM_fw(padded, cell_spacing, 0.025, k), expected, atol=1e-12*abs(expected).max())
+    
+    
+def test_ASM_Iterative_GS_batch_processes_keep_the_settings():
+    
+    import os
+    import subprocess
+    import sys
+    
+    # spawned processes start from the default settings, unlike forked ones
+    script = "\n".join([
+        "import multiprocessing, numpy as np",
+        "from functions import set_precision",
+        "from fft_functions import set_fft_backend",
+        "from ASM_functions import ASM_Iterative_GS_batch",
+        "if __name__ == '__main__':",
+        "    multiprocessing.set_start_method('spawn')",
+        "    set_precision('single')",
+        "    set_fft_backend('numpy')",
+        "    targets = np.ones((4, 8, 8))",
+        "    serial = ASM_Iterative_GS_batch(targets, np.ones((8, 8)), 2, 343/40000/2, 0.02, 2*np.pi*40000/343)",
+        "    parallel = ASM_Iterative_GS_batch(targets, np.ones((8, 8)), 2, 343/40000/2, 0.02, 2*np.pi*40000/343,",
+        "                                      workers=2)",
+        "    print(serial.dtype, parallel.dtype, np.array_equal(serial, parallel))",
+    ])
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", script], cwd=root, capture_output=True, text=True, timeout=120,
+                            env=dict(os.environ, PYTHONPATH=root))
+    
+    assert result.stdout.split() == ["complex64", "complex64", "True"], result.stderr
@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+from GF_functions import GF_propagator_function_builder, GFGS
+
+
+k = 2*np.pi*40000/343
+
+
+def propagator(precision, N=8, target_dist=0.05):
+    
+    cell_spacing = 343/40000/2
+    x = (np.arange(N) - (N - 1)/2)*cell_spacing
+    xx, yy = np.meshgrid(x, x)
+    reflector_points = np.stack((xx.ravel(), yy.ravel(), np.zeros(N*N)), axis=1)
+    eval_points = reflector_points + [0, 0, target_dist]
+    normals = [np.zeros((1, N*N)), np.zeros((1, N*N)), np.ones((1, N*N))]
+    areas = np.full((1, N*N), cell_spacing**2)
+    
+    return GF_propagator_function_builder(reflector_points, eval_points, normals, areas, k, precision)
+
+
+@pytest.mark.parametrize("precision, dtype", [("single", np.complex64), ("double", np.complex128)])
+def test_GFGS_keeps_the_precision_of_the_propagator(precision, dtype):
+    
+    H = propagator(precision)
+    target = np.zeros((8, 8))
+    target[2:6, 3] = 1
+    
+    spp = GFGS(H, np.ones(64, dtype=complex), target.reshape(-1, 1), iterations=3)
+    
+    assert H.dtype == dtype
+    assert spp.dtype == dtype
+    
+    
+def test_GF_propagator_function_builder_threaded_allocates_only_H_and_scratch():
+    
+    import tracemalloc
+    from GF_functions import GF_propagator_function_builder_threaded
+    
+    cell_spacing = 343/40000/2
+    x = (np.arange(32) - 15.5)*cell_spacing
+    xx, yy = np.meshgrid(x, x)
+    reflector_points = np.stack((xx.ravel(), yy.ravel(), np.zeros(1024)), axis=1)
+    eval_points = np.concatenate((reflector_points[:10], reflector_points + [0.001, 0.002, 0.05]))
+    normals = [np.zeros((1, 1024)), np.zeros((1, 1024)), np.ones((1, 1024))]
+    areas = np.full((1, 1024), cell_spacing**2)
+    block_shape = (128, 1024)
+    
+    GF_propagator_function_builder_threaded(reflector_points, eval_points, normals, areas, k, 1, block_shape)
+    tracemalloc.start()
+    H = GF_propagator_function_builder_threaded(reflector_points, eval_points, normals, areas, k, 1, block_shape)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    # six real scratch buffers and one mask per thread, 7.3 MB before per-block temporaries were removed
+    assert peak - H.nbytes < 6.5*2**20
+    
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = GF_propagator_function_builder(reflector_points, eval_points, normals, areas, k)
+    coincident = ~np.isfinite(expected)
+    
+    assert np.all(H[coincident] == 0)
+    np.testing.assert_allclose(H[~coincident], expected[~coincident], rtol=1e-12, atol=1e-12*abs(H).max())
+    
+    
+def grid(nx, ny, spacing, origin=(0, 0, 0)):
+    
+    # x varies fastest, as in functions.points_vector_builder
+    xx, yy = np.meshgrid(origin[0] + spacing*np.arange(nx), origin[1] + spacing*np.arange(ny))
+    
+    return np.stack((xx.ravel(), yy.ravel(), np.full(xx.size, origin[2])), axis=1)
+
+
+def flat_elements(count, area):
+    
+    return [np.zeros((1, count)), np.zeros((1, count)), np.ones((1, count))], np.full((1, count), area)
+
+
+@pytest.mark.parametrize("resolution", [1, 2, 3])
+@pytest.mark.parametrize("prop_direction", ["forward", "backward"])
+def test_GF_prop_fft_matches_GF_prop(resolution, prop_direction):
+    
+    from GF_functions import GF_prop, GF_prop_fft, GF_prop_auto
+    
+    cell_spacing = 343/40000/2
+    reflector_points = grid(7, 5, cell_spacing)
+    
+    # an evaluation grid offset from the reflectors by a fraction of a cell, and of a different size
+    eval_points = grid(11, 9, cell_spacing/resolution, origin=(-0.37*cell_spacing, 0.81*cell_spacing, 0.04))
+    normals, areas = flat_elements(len(reflector_points), cell_spacing**2)
+    pressure = np.exp(1j*np.random.default_rng(0).uniform(0, 2*np.pi, (2, len(reflector_points))))
+    
+    H = GF_propagator_function_builder(reflector_points, eval_points, normals, areas, k, "double")
+    expected = GF_prop(pressure, H, prop_direction)
+    
+    for propagate in (GF_prop_fft, GF_prop_auto):
+        field = propagate(pressure, reflector_points, eval_points, normals, areas, k, prop_direction,
+                          precision="double")
+        np.testing.assert_allclose(field, expected, atol=1e-12*abs(expected).max())
+        
+    np.testing.assert_allclose(GF_prop_fft(pressure[0], reflector_points, eval_points, normals, areas, k,
+                                           prop_direction, "double"), expected[0], atol=1e-12*abs(expected).max())
+    
+    
+def test_GF_fft_resolution_rejects_unsuitable_geometries():
+    
+    from GF_functions import GF_fft_resolution, GF_regular_grid
+    
+    cell_spacing = 343/40000/2
+    reflector_points = grid(6, 4, cell_spacing)
+    eval_points = grid(8, 8, cell_spacing/2, origin=(0.001, 0.002, 0.05))
+    normals, areas = flat_elements(len(reflector_points), cell_spacing**2)
+    
+    assert GF_fft_resolution(reflector_points, eval_points, normals, areas)[0] == 2
+    
+    # non-uniform areas
+    uneven_areas = areas.copy()
+    uneven_areas[0, 3] *= 1.5
+    assert GF_fft_resolution(reflector_points, eval_points, normals, uneven_areas)[0] is None
+    
+    # which GF_prop_auto then propagates with the tiled dense propagator
+    from GF_functions import GF_prop, GF_prop_auto
+    pressure = np.ones(len(reflector_points), dtype=complex)
+    H = GF_propagator_function_builder(reflector_points, eval_points, normals, uneven_areas, k, "double")
+    np.testing.assert_allclose(GF_prop_auto(pressure, reflector_points, eval_points, normals, uneven_areas, k,
+                                            "forward", precision="double"), GF_prop(pressure, H, "forward"))
+    
+    # non-uniform normals
+    tilted = [normal.copy() for normal in normals]
+    tilted[0][0, 2], tilted[2][0, 2] = 0.6, 0.8
+    assert GF_fft_resolution(reflector_points, eval_points, tilted, areas)[0] is None
+    
+    # non-integer ratio of the spacings
+    assert GF_fft_resolution(reflector_points, grid(8, 8, cell_spacing/1.5, origin=(0, 0, 0.05)), normals,
+                             areas)[0] is None
+    
+    # points off a regular grid, or not in a plane of constant z
+    jittered = eval_points.copy()
+    jittered[5, 0] += 0.1*cell_spacing
+    assert GF_regular_grid(jittered) is None
+    assert GF_fft_resolution(reflector_points, jittered, normals, areas)[0] is None
+    sloped = eval_points.copy()
+    sloped[:, 2] += 0.01*sloped[:, 0]
+    assert GF_fft_resolution(reflector_points, sloped, normals, areas)[0] is None
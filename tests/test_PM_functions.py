@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+from PM_functions import PM_GSPAT, PM_GSPAT_trajectory, PM_prop, PM_propagator_vectorised
+
+
+k = 2*np.pi*40000/343
+normal = [0, 0, 1]
+
+
+def board(n=16, pitch=10.5/1000):
+    
+    x = (np.arange(n) - (n - 1)/2)*pitch
+    xx, yy = np.meshgrid(x, x)
+    
+    return np.stack((xx.ravel(), yy.ravel(), np.zeros(n*n)), axis=1)
+
+
+def circular_trajectory(frames=100):
+    
+    traps = np.array([[0.02, 0, 0], [-0.02, 0, 0], [0, 0.02, 0], [0, -0.02, 0]])
+    
+    for t in np.linspace(0, 2*np.pi, frames):
+        yield traps + [0.02*np.cos(t), 0.02*np.sin(t), 0.1]
+
+
+def amplitude_spread(tran_phases, points, tran_points):
+    
+    amplitudes = abs(np.exp(1j*tran_phases) @ PM_propagator_vectorised(points, tran_points, normal, k))
+    
+    return amplitudes.std() / amplitudes.mean()
+
+
+def test_PM_GSPAT_trajectory_warm_start_beats_cold_start():
+    
+    tran_points = board()
+    frames = list(circular_trajectory())
+    
+    warm = [amplitude_spread(tran_phases, points, tran_points) for tran_phases, points in
+            zip(PM_GSPAT_trajectory(frames, tran_points, normal, k, iterations=2), frames)]
+    cold = [amplitude_spread(PM_GSPAT(PM_propagator_vectorised(points, tran_points, normal, k), iterations=2)[0],
+                             points, tran_points) for points in frames]
+    
+    assert np.mean(warm[1:]) < 0.5*np.mean(cold[1:])
+    
+    
+def test_PM_GSPAT_trajectory_sees_frames_updated_in_place():
+    
+    tran_points = board(8)
+    frames = list(circular_trajectory(10))
+    
+    def updated_in_place():
+        points = np.zeros((4, 3))
+        for frame in frames:
+            points[:] = frame
+            yield points
+            
+    expected = list(PM_GSPAT_trajectory(frames, tran_points, normal, k))
+    stats = {}
+    result = list(PM_GSPAT_trajectory(updated_in_place(), tran_points, normal, k, stats=stats))
+    
+    assert stats["columns_updated"] == 4*len(frames)
+    np.testing.assert_allclose(result, expected)
+    
+    
+def test_PM_GSPAT_batch_matches_single():
+    
+    tran_points = board(8)
+    H = np.stack([PM_propagator_vectorised(points, tran_points, normal, k) for points in circular_trajectory(3)])
+    
+    tran_phases, point_phases, weights = PM_GSPAT(H)
+    
+    for i in range(len(H)):
+        single = PM_GSPAT(H[i])
+        np.testing.assert_allclose(tran_phases[i], single[0])
+        np.testing.assert_allclose(weights[i], single[2])
+    
+    
+@pytest.mark.parametrize("precision, dtype", [("single", np.complex64), ("double", np.complex128)])
+def test_PM_prop_keeps_the_precision_of_the_propagator(precision, dtype):
+    
+    target_points = board(4) + [0, 0, 0.1]
+    
+    assert PM_prop(target_points, board(), normal, k, precision=precision).dtype == dtype
+    
+    
+def test_PM_GSPAT_zero_target_amplitudes():
+    
+    tran_points = board(8)
+    points = next(circular_trajectory())
+    H = PM_propagator_vectorised(points, tran_points, normal, k)
+    
+    tran_phases, point_phases, weights = PM_GSPAT(H, [1, 1, 1, 0])
+    
+    assert np.all(np.isfinite(tran_phases)) and np.all(np.isfinite(weights))
+    
+    # the driven points are equalised as if the undriven one were not there
+    amplitudes = abs(np.exp(1j*tran_phases) @ H[:, :3])
+    expected = abs(np.exp(1j*PM_GSPAT(H[:, :3])[0]) @ H[:, :3])
+    np.testing.assert_allclose(amplitudes, expected)
+    
+    
+def test_PM_directivity_table_follows_the_precision_setting():
+    
+    from functions import set_precision, get_precision
+    from PM_functions import PM_directivity_table
+    
+    previous = get_precision()
+    try:
+        set_precision("double")
+        assert PM_directivity_table(k).dtype == np.float64
+        set_precision("single")
+        assert PM_directivity_table(k).dtype == np.float32
+    finally:
+        set_precision(previous)
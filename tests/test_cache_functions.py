@@ -0,0 +1,48 @@
+import numpy as np
+from cache_functions import PropagatorCache, cached_PM_propagator_function_builder
+
+
+def test_PropagatorCache_keeps_arrays_in_memory(tmp_path):
+    
+    cache = PropagatorCache(cache_dir=str(tmp_path))
+    array = np.arange(10, dtype=complex)
+    
+    cached = cache.put("key", array)
+    
+    assert cached is array
+    assert not isinstance(cached, np.memmap)
+    assert not cached.flags.writeable
+    assert cache.get("key") is array
+    
+    
+def test_PropagatorCache_reloads_from_disk(tmp_path):
+    
+    cache = PropagatorCache(cache_dir=str(tmp_path))
+    cache.put("key", np.arange(10, dtype=complex))
+    cache.clear()
+    
+    array = cache.get("key")
+    
+    assert not isinstance(array, np.memmap)
+    assert not array.flags.writeable
+    np.testing.assert_array_equal(array, np.arange(10))
+    assert PropagatorCache(max_bytes=8, cache_dir=str(tmp_path)).get("key").shape == (10,)
+    
+    
+def test_cached_PM_propagator_function_builder_keys_the_directivity():
+    
+    from PM_functions import PM_propagator_function_builder, PM_measured_directivity
+    
+    k = 2*np.pi*40000/343
+    tp_vec = np.linspace(0.05, 0.2, 50)
+    sin_theta = np.linspace(0, 0.99, 50)
+    angles = np.linspace(0, np.pi/2, 10)
+    tables = [PM_measured_directivity(angles, np.cos(angles)**power) for power in (1, 2)]
+    cache = PropagatorCache()
+    
+    for directivity in ["taylor", "exact"] + tables:
+        H = cached_PM_propagator_function_builder(tp_vec, sin_theta, k, cache=cache, directivity=directivity)
+        np.testing.assert_array_equal(H, PM_propagator_function_builder(tp_vec, sin_theta, k,
+                                                                        directivity=directivity))
+        
+    assert cache.misses == 4
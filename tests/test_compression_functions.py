@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+from compression_functions import LowRankPropagator, BlockPropagator, aca_compress, randomized_svd_compress, \
+    compress_propagator
+from GF_functions import GF_propagator_function_builder, GF_compressed_propagator_builder, GF_prop, GFGS, GFGS_batch
+
+
+k = 2*np.pi*40000/343
+cell_spacing = 343/40000/2
+
+
+def far_field_geometry(N=16, resolution=16, target_dist=0.5):
+    
+    x = (np.arange(N) - (N - 1)/2)*cell_spacing
+    xx, yy = np.meshgrid(x, x)
+    reflector_points = np.stack((xx.ravel(), yy.ravel(), np.zeros(N*N)), axis=1)
+    
+    x = np.linspace(-0.05, 0.05, resolution)
+    xx, yy = np.meshgrid(x, x)
+    eval_points = np.stack((xx.ravel(), yy.ravel(), np.full(xx.size, target_dist)), axis=1)
+    
+    normals = [np.zeros((1, N*N)), np.zeros((1, N*N)), np.ones((1, N*N))]
+    areas = np.full((1, N*N), cell_spacing**2)
+    
+    return reflector_points, eval_points, normals, areas
+
+
+def relative_error(a, b):
+    
+    return np.linalg.norm(a - b) / np.linalg.norm(b)
+
+
+def low_rank_matrix(shape=(40, 60), rank=5, seed=0):
+    
+    rng = np.random.default_rng(seed)
+    U = rng.standard_normal((shape[0], rank)) + 1j*rng.standard_normal((shape[0], rank))
+    V = rng.standard_normal((rank, shape[1])) + 1j*rng.standard_normal((rank, shape[1]))
+    
+    return U @ V
+
+
+@pytest.mark.parametrize("axis", [0, 1])
+def test_BlockPropagator_matches_dense(axis):
+    
+    H = low_rank_matrix()
+    rng = np.random.default_rng(1)
+    
+    # blocks of rows (axis=0) or columns (axis=1), one dense and two low-rank
+    edges = [0, 13, 27, H.shape[axis]]
+    pieces = np.split(H, edges[1:-1], axis=axis)
+    blocks = [pieces[0]] + [randomized_svd_compress(piece, 1e-12) for piece in pieces[1:]]
+    propagator = BlockPropagator(blocks, axis)
+    
+    assert propagator.shape == H.shape and propagator.dtype == H.dtype
+    np.testing.assert_allclose(propagator.toarray(), H, atol=1e-10)
+    
+    for operator, dense in ((propagator, H), (propagator.T, H.T), (propagator.conj(), H.conj()),
+                            (propagator.T.conj(), H.T.conj())):
+        right = rng.standard_normal(dense.shape[1]) + 0j
+        left = rng.standard_normal((3, dense.shape[0])) + 0j
+        np.testing.assert_allclose(operator @ right, dense @ right, atol=1e-9)
+        np.testing.assert_allclose(operator @ right[:, None], dense @ right[:, None], atol=1e-9)
+        np.testing.assert_allclose(left @ operator, left @ dense, atol=1e-9)
+        np.testing.assert_allclose(left[0] @ operator, left[0] @ dense, atol=1e-9)
+        
+        
+def test_LowRankPropagator_matches_dense():
+    
+    rng = np.random.default_rng(2)
+    U, V = rng.standard_normal((30, 4)) + 1j, rng.standard_normal((4, 50)) - 1j
+    propagator, H = LowRankPropagator(U, V), U @ V
+    
+    assert propagator.shape == H.shape and propagator.rank == 4
+    
+    for operator, dense in ((propagator, H), (propagator.T, H.T), (propagator.conj(), H.conj())):
+        right, left = rng.standard_normal((dense.shape[1], 2)), rng.standard_normal((2, dense.shape[0]))
+        np.testing.assert_allclose(operator @ right, dense @ right)
+        np.testing.assert_allclose(left @ operator, left @ dense)
+        
+        
+def test_compressors_find_the_rank():
+    
+    H = low_rank_matrix(rank=5)
+    
+    for compressed in (randomized_svd_compress(H, 1e-10),
+                       aca_compress(lambda i: H[i], lambda j: H[:, j], H.shape, 1e-10, dtype=H.dtype)):
+        assert compressed.rank <= 6
+        assert relative_error(compressed.toarray(), H) < 1e-8
+        
+        
+@pytest.mark.parametrize("method", ["aca", "svd"])
+@pytest.mark.parametrize("block_length", [None, 64])
+def test_compressed_GF_propagator_matches_dense(method, block_length):
+    
+    tol = 1e-6
+    geometry = far_field_geometry()
+    H = GF_propagator_function_builder(*geometry, k, "double")
+    compressed = GF_compressed_propagator_builder(*geometry, k, tol, method, block_length, precision="double")
+    
+    assert compressed.nbytes < H.nbytes
+    assert relative_error(compressed.toarray(), H) < 10*tol
+    
+    rng = np.random.default_rng(3)
+    surface = np.exp(1j*rng.uniform(0, 2*np.pi, (4, H.shape[0])))
+    for prop_direction in ("forward", "backward"):
+        assert relative_error(GF_prop(surface, compressed, prop_direction),
+                              GF_prop(surface, H, prop_direction)) < 10*tol
+        assert relative_error(GF_prop(surface[0], compressed, prop_direction),
+                              GF_prop(surface[0], H, prop_direction)) < 10*tol
+        
+        
+def test_compressed_GF_propagator_in_GFGS():
+    
+    tol = 1e-10
+    geometry = far_field_geometry()
+    H = GF_propagator_function_builder(*geometry, k, "double")
+    compressed = GF_compressed_propagator_builder(*geometry, k, tol, "aca", 64, precision="double")
+    incident = np.ones(H.shape[0], dtype=complex)
+    target = np.zeros((16, 16))
+    target[5:11, 6:9] = 1
+    
+    expected = GFGS(H, incident, target.reshape(-1, 1), iterations=5)
+    np.testing.assert_allclose(GFGS(compressed, incident, target.reshape(-1, 1), iterations=5), expected, atol=1e-6)
+    
+    expected, _ = GFGS_batch(H, incident, target.reshape(1, -1), max_iterations=5)
+    result, _ = GFGS_batch(compressed, incident, target.reshape(1, -1), max_iterations=5)
+    np.testing.assert_allclose(result, expected, atol=1e-6)
+    
+    
+def test_compress_propagator_keeps_incompressible_blocks_dense():
+    
+    rng = np.random.default_rng(4)
+    H = np.concatenate((low_rank_matrix((40, 30), 2), rng.standard_normal((40, 30)) + 0j), axis=1)
+    
+    compressed = compress_propagator(H, 1e-10, block_length=30)
+    
+    assert isinstance(compressed.blocks[0], LowRankPropagator)
+    assert isinstance(compressed.blocks[1], np.ndarray)
+    assert relative_error(compressed.toarray(), H) < 1e-8
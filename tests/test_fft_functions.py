@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import fft_functions
+from fft_functions import set_fft_backend, fft2, ifft2, ifft
+
+
+@pytest.fixture(params=["numpy", "scipy"])
+def backend(request):
+    
+    set_fft_backend(request.param)
+    yield request.param
+    set_fft_backend("scipy")
+    
+
+def random_field(shape=(3, 16, 12)):
+    
+    rng = np.random.default_rng(0)
+    
+    return rng.standard_normal(shape) + 1j*rng.standard_normal(shape)
+
+
+def test_transforms_into_out(backend):
+    
+    a = random_field()
+    out = np.empty_like(a)
+    
+    assert fft2(a, out=out) is out
+    np.testing.assert_allclose(out, np.fft.fft2(a), atol=1e-12)
+    assert ifft(a, axis=1, out=out) is out
+    np.testing.assert_allclose(out, np.fft.ifft(a, axis=1), atol=1e-12)
+    
+    
+def test_transforms_in_place(backend):
+    
+    a = random_field()
+    expected = np.fft.ifft2(a)
+    
+    assert ifft2(a, out=a, overwrite_input=True) is a
+    np.testing.assert_allclose(a, expected, atol=1e-12)
+    
+    
+def test_out_does_not_allocate_a_result(backend):
+    
+    import tracemalloc
+    
+    if backend == "numpy" and not fft_functions.numpy_fft_out:
+        pytest.skip("np.fft only takes an output array from NumPy 2.0")
+        
+    a = random_field((4, 128, 128))
+    out = np.empty_like(a)
+    fft2(a, out=out)
+    
+    tracemalloc.start()
+    fft2(a, out=out)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    assert peak < a.nbytes / 4
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from functions import focus_phasemap_builder_batch
+from steering_functions import SteeringTable, steering_table_builder
+
+
+k = 2*np.pi*40000/343
+
+x_values = np.linspace(-0.01, 0.01, 21)
+y_values = np.linspace(-0.01, 0.01, 21)
+z_values = np.linspace(-0.11, -0.09, 21)
+low, high = [-0.01, -0.01, -0.11], [0.01, 0.01, -0.09]
+
+
+def board(n=16, pitch=10.5/1000):
+
+    x = (np.arange(n) - (n - 1)/2)*pitch
+    xx, yy = np.meshgrid(x, x)
+
+    return np.stack((xx.ravel(), yy.ravel(), np.zeros(n*n)), axis=1)
+
+
+def phase_error(a, b):
+
+    return abs(np.angle(np.exp(1j*(a - b))))
+
+
+@pytest.fixture(scope="module")
+def filename(tmp_path_factory):
+
+    return str(tmp_path_factory.mktemp("steering") / "table.npy")
+
+
+@pytest.fixture(scope="module")
+def table(filename):
+
+    return steering_table_builder(filename, board(), k, x_values, y_values, z_values, error_samples=200)
+
+
+def test_steering_table_reopens_from_disk(table, filename):
+
+    reopened = SteeringTable(filename)
+
+    assert reopened.max_phase_error == table.max_phase_error
+    assert 0 < table.max_phase_error < 0.05
+    assert np.array_equal(reopened.query([0.001, 0.002, -0.1]), table.query([0.001, 0.002, -0.1]))
+
+
+def test_steering_table_single_query_matches_batch(table):
+
+    focal_points = np.random.default_rng(1).uniform(low, high, size=(20, 3))
+    batch = table.query(focal_points)
+
+    for focal_point, phases in zip(focal_points, batch):
+        single = table.query(focal_point)
+        assert single.shape == phases.shape
+        assert phase_error(single, phases).max() < 1e-5
+
+
+def test_steering_table_within_max_phase_error(table):
+
+    focal_points = np.random.default_rng(2).uniform(low, high, size=(500, 3))
+    exact = focus_phasemap_builder_batch(board(), focal_points, k)
+
+    # grid points are stored exactly
+    on_grid = np.array([[x_values[3], y_values[5], z_values[0]]])
+    assert phase_error(table.query(on_grid), focus_phasemap_builder_batch(board(), on_grid, k)).max() < 1e-5
+
+    # the stored error was measured on a sample of cells, so allow a little slack for the unsampled ones
+    assert phase_error(table.query(focal_points), exact).max() < 1.1*table.max_phase_error
+
+
+def test_steering_table_clamps_outside_the_grid(table):
+
+    edge = np.array([x_values[-1], y_values[0], z_values[-1]])
+    outside = edge + [0.01, -0.01, 0.01]
+
+    assert phase_error(table.query(outside), table.query(edge)).max() < 1e-5
+    assert phase_error(table.query(outside[None]), table.query(edge[None])).max() < 1e-5
+
+    # clamped, not extrapolated: half a step past the last grid point the phasemap is still the edge one, which is
+    # about 0.25 rad out, far beyond the in-grid error
+    past = np.array([[x_values[-1] + 0.5*(x_values[1] - x_values[0]), 0, -0.1]])
+    error = phase_error(table.query(past), focus_phasemap_builder_batch(board(), past, k)).max()
+    assert 0.2 < error < 0.3
+    assert error > 10*table.max_phase_error